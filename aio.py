@@ -0,0 +1,93 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class AsyncRunner:
+    """
+    Runs coroutine handlers. They all share one event loop in a dedicated thread. In asyncio mode the catbot thread
+    that received the update returns as soon as the coroutine is submitted. Otherwise it waits for the coroutine to
+    finish, as it would for a sync handler. Either way, blocking bot calls are awaited through call(), which runs them
+    in a shared thread pool, so independent calls of a handler overlap.
+
+    The pool size `workers` bounds the blocking calls running at once, not the handlers in flight: a coroutine holds
+    no thread while it waits on the loop. Waits that can be long, such as for outbound rate limits, should therefore
+    be awaited on the loop (see OutboundLimiter.acquire_async()) rather than made inside call().
+    """
+
+    def __init__(self, enabled: bool = False, workers: int = 32):
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aio')
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='aio', daemon=True).start()
+
+    def submit(self, coro) -> Future:
+        """
+        Schedule a coroutine on the event loop from any thread.
+        """
+        if self._loop is None:
+            self.start()
+        with self._lock:
+            self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        error = future.exception()
+        with self._lock:
+            self.in_flight -= 1
+            if error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if error is not None:
+            logging.error('Coroutine handler failed', exc_info=error)
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Await a blocking function run in the thread pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    def adapt(self, func):
+        """
+        Wrap a handler for registration with catbot. Sync handlers are returned unchanged.
+        """
+        if not asyncio.iscoroutinefunction(func):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.enabled:
+                self.submit(func(*args, **kwargs))
+            else:
+                # Reuse the loop rather than set up a new one per update, as asyncio.run() would
+                self.start()
+                asyncio.run_coroutine_threadsafe(func(*args, **kwargs), self._loop).result()
+
+        return wrapper
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed
+        }
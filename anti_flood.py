@@ -1,11 +1,19 @@
-from catbot import Message, Chat
+import collections
+import logging
+import threading
+
+from catbot import Message, Chat, APIError
+
+from timeout import Scheduler
 
 
 class AntiFlood:
     def __init__(self):
         self.message: Message | None = None
         self.enabled = False
+        self.auto = False
         self.counter = 0
+        self.lock = threading.Lock()
 
     @property
     def chat(self) -> Chat:
@@ -19,10 +27,144 @@ class AntiFlood:
     def msg_id(self):
         return self.message.id
 
-    def enable(self, msg: Message):
+    def enable(self, msg: Message, auto: bool = False):
+        """
+        :param auto: Whether anti-flood is enabled by the join rate rather than by an admin. Only automatically enabled
+                     anti-flood is disabled automatically.
+        """
         self.enabled = True
+        self.auto = auto
         self.message = msg
         self.counter = 0
 
     def disable(self):
         self.enabled = False
+        self.auto = False
+
+
+class FloodDetector:
+    """
+    Sliding window of join timestamps per chat. Each chat has its own deque and lock, so eviction is amortised O(1)
+    and a busy chat never blocks the others. Chats without joins for `idle` seconds are swept away.
+    """
+
+    def __init__(self, period: int, count: int, idle: int = 3600):
+        self.period = period
+        self.count = count
+        self.idle = idle
+        self._windows: dict[int, tuple[collections.deque[float], threading.Lock]] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _window(self, chat_id: int) -> tuple[collections.deque[float], threading.Lock]:
+        window = self._windows.get(chat_id)
+        if window is None:
+            with self._lock:
+                window = self._windows.setdefault(chat_id, (collections.deque(), threading.Lock()))
+        return window
+
+    def hit(self, chat_id: int, timestamp: float) -> int:
+        """
+        Record a join and return the number of joins within the last `period` seconds, including this one.
+        """
+        while True:
+            window = self._window(chat_id)
+            timestamps, lock = window
+            with lock:
+                while timestamps and timestamps[0] < timestamp - self.period:
+                    timestamps.popleft()
+                timestamps.append(timestamp)
+                count = len(timestamps)
+            # sweep() may have dropped the window between the lookup and the append, leaving the join in a deque
+            # nobody counts any more. It checks idleness under the window lock, so a window still there is safe.
+            if self._windows.get(chat_id) is window:
+                break
+        if timestamp - self._last_sweep > self.idle:
+            self.sweep(timestamp)
+        return count
+
+    def is_flooding(self, chat_id: int, timestamp: float) -> bool:
+        return self.hit(chat_id, timestamp) >= self.count
+
+    def recent(self, chat_id: int, now: float) -> int:
+        """
+        Return the number of joins within the last `period` seconds without recording one.
+        """
+        window = self._windows.get(chat_id)
+        if window is None:
+            return 0
+        timestamps, lock = window
+        with lock:
+            while timestamps and timestamps[0] < now - self.period:
+                timestamps.popleft()
+            return len(timestamps)
+
+    def sweep(self, now: float) -> int:
+        """
+        Drop windows of chats idle for longer than `idle` seconds.
+        :return: Number of chats dropped
+        """
+        self._last_sweep = now
+        dropped = 0
+        with self._lock:
+            for chat_id, (timestamps, lock) in list(self._windows.items()):
+                with lock:
+                    if not timestamps or timestamps[-1] < now - self.idle:
+                        del self._windows[chat_id]
+                        dropped += 1
+        return dropped
+
+    def __len__(self):
+        return len(self._windows)
+
+
+class CounterEditQueue:
+    """
+    Debounce anti-flood counter edits. Only the latest text of each chat is kept, and it is sent at most once per
+    `interval` seconds, instead of one edit per join which soon hits the per-chat rate limit.
+    """
+
+    def __init__(self, edit, scheduler: Scheduler, interval: float = 3):
+        """
+        :param edit: Callable taking (chat_id, msg_id, text) that performs the edit
+        """
+        self._edit = edit
+        self._scheduler = scheduler
+        self.interval = interval
+        self._pending: dict[int, tuple[int, str]] = {}
+        self._lock = threading.Lock()
+
+        self.requested = 0
+        self.sent = 0
+
+    def push(self, chat_id: int, msg_id: int, text: str):
+        with self._lock:
+            self.requested += 1
+            first = chat_id not in self._pending
+            self._pending[chat_id] = (msg_id, text)
+        if first:
+            self._scheduler.schedule('counter_edit', self.interval, self.flush, chat_id)
+
+    def flush(self, chat_id: int):
+        with self._lock:
+            item = self._pending.pop(chat_id, None)
+        if item is None:
+            return
+        msg_id, text = item
+        self.sent += 1
+        try:
+            self._edit(chat_id, msg_id, text)
+        except APIError as e:
+            logging.info(e.args[0])
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.sent - len(self._pending)
+
+    def stats(self) -> dict:
+        return {
+            'requested': self.requested,
+            'sent': self.sent,
+            'pending': len(self._pending),
+            'saved': self.saved
+        }
@@ -0,0 +1,52 @@
+"""
+Compare the per-pattern re.search loop formerly used by match_blacklist with BlacklistMatcher.
+
+Run from the repository root: python -m benchmarks.blacklist
+"""
+import random
+import re
+import string
+import timeit
+
+from blacklist import BlacklistMatcher
+
+
+def make_patterns(count: int) -> list[str]:
+    rng = random.Random(count)
+    patterns = []
+    for i in range(count):
+        word = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+        if i % 4 == 0:
+            patterns.append(word[:3] + r'\d{2,}' + word[3:])
+        elif i % 4 == 1:
+            patterns.append(word + r'\s*(bot|vip)')
+        else:
+            patterns.append(word)
+    return patterns
+
+
+def old_match(patterns: list[str], tokens: list[str]) -> bool:
+    for reg in patterns:
+        for token in tokens:
+            if re.search(reg, token):
+                return True
+    return False
+
+
+def main():
+    tokens = ['Alice Wonderland', 'Just a regular user who likes cats and long walks on the beach. 你好，世界']
+    print(f'{"patterns":>8} {"old (us/join)":>14} {"new (us/join)":>14} {"speedup":>8} {"build (ms)":>11}')
+    for count in (10, 100, 1000):
+        patterns = make_patterns(count)
+        re.purge()
+        build = timeit.timeit(lambda: BlacklistMatcher(patterns), number=1)
+        matcher = BlacklistMatcher(patterns)
+        assert matcher.match(tokens) == old_match(patterns, tokens)
+        number = max(10, 20000 // count)
+        old = timeit.timeit(lambda: old_match(patterns, tokens), number=number) / number
+        new = timeit.timeit(lambda: matcher.match(tokens), number=number) / number
+        print(f'{count:>8} {old * 1e6:>14.1f} {new * 1e6:>14.1f} {old / new:>7.1f}x {build * 1e3:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Compare generating MathChallenges one by one with MathChallenge.batch().
+
+Run from the repository root: python -m benchmarks.challenge
+"""
+import collections
+import timeit
+
+from challenge import MathChallenge
+
+
+def check(challenges: list[MathChallenge]):
+    for challenge in challenges:
+        choices = challenge.choices()
+        assert len(choices) == 6 and len(set(choices)) == 6
+        assert challenge.ans() in choices and choices[0] != challenge.ans()
+
+
+def main():
+    check(MathChallenge.batch(100000))
+    slots = collections.Counter(challenge.choices().index(challenge.ans()) for challenge in MathChallenge.batch(100000))
+    print('answer slot distribution of batch():', dict(sorted(slots.items())))
+    print(f'{"count":>8} {"one by one (ms)":>16} {"batch (ms)":>11} {"speedup":>8}')
+    for count in (1000, 10000, 50000):
+        single = min(timeit.repeat(lambda: [MathChallenge() for _ in range(count)], number=1, repeat=3))
+        batch = min(timeit.repeat(lambda: MathChallenge.batch(count), number=1, repeat=3))
+        print(f'{count:>8} {single * 1e3:>16.1f} {batch * 1e3:>11.1f} {single / batch:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Drive the handlers of main.py with a stream of joins and button clicks, against a fake Telegram Bot API and a fake
+Wikisource, and report join-to-CAPTCHA latency, click-to-result latency, API calls per join, threads, memory and
+throughput.
+
+The fake Telegram API replaces catbot.Bot.api, through which catbot makes every request, and answers after
+`--api-latency` seconds. The fake Wikisource takes the place of the shared mwclient site. Updates go through the
+queue and workers of WebhookServer, as in webhook mode, without the HTTP server.
+
+Run from the repository root, e.g. 1000 joins per minute across 500 chats:
+    python -m benchmarks.load_test --joins 1000 --chats 500 --rate 1000
+A recorded stream, one {"at": <seconds from start>, "update": <Telegram update>} per line, is replayed with --replay,
+and a synthetic stream is saved for later replays with --save.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import catbot
+
+from challenge import TextReadingChallenge
+from timeout import Timeout
+from webhook import WebhookServer
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'CAPTCHA', 'username': 'captcha_bot'}
+CAPTCHA_USER = re.compile(r'tg://user\?id=(\d+)')
+CHALLENGE_DATA = re.compile(r'c:[\w-]+:\d+:\d+:[0-9a-z]+:[\w-]+')
+
+
+def user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def chat(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'supergroup', 'title': f'Group {chat_id}'}
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+class FakeTelegram:
+    """
+    Answers Bot API methods from memory, counting calls per method and reporting sent CAPTCHAs to `on_captcha`.
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.on_captcha = None
+        self.on_edit = None
+        self._msg_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def api(self, action: str, data: dict | None = None):
+        data = data or {}
+        with self._lock:
+            self.calls[action] += 1
+        time.sleep(self.latency)
+
+        if action == 'getMe':
+            return BOT_USER
+        if action == 'sendMessage':
+            message = {
+                'message_id': next(self._msg_ids),
+                'from': BOT_USER,
+                'chat': chat(data['chat_id']),
+                'date': int(time.time()),
+                'text': data.get('text', '')
+            }
+            markup = data.get('reply_markup')
+            if markup is not None and self.on_captcha is not None:
+                found = CAPTCHA_USER.search(message['text'])
+                if found is not None:
+                    self.on_captcha(int(found.group(1)), message, CHALLENGE_DATA.findall(str(markup)))
+            return message
+        if action == 'editMessageText':
+            if self.on_edit is not None:
+                self.on_edit(data['chat_id'], data['message_id'])
+            return {
+                'message_id': data['message_id'],
+                'from': BOT_USER,
+                'chat': chat(data['chat_id']),
+                'date': int(time.time()),
+                'text': data.get('text', '')
+            }
+        if action == 'getChat':
+            return {'id': data['chat_id'], 'type': 'private', 'first_name': f'User{data["chat_id"]}', 'bio': ''}
+        if action == 'getChatMember':
+            return {'user': user(data['user_id']), 'status': 'restricted', 'is_member': True, 'until_date': 0}
+        if action == 'getChatAdministrators':
+            return [{'user': BOT_USER, 'status': 'administrator'}]
+        return True
+
+
+class FakeWikisource:
+    """
+    Stands in for the mwclient site used by TextReadingChallenge.fetch_texts().
+    """
+
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+        self.queries = 0
+
+    def api(self, action: str, **kwargs) -> dict:
+        self.queries += 1
+        time.sleep(self.latency)
+        pages = [
+            {'extract': ''.join(chr(random.randint(0x4e00, 0x9fff)) for _ in range(30))}
+            for _ in range(int(kwargs.get('grnlimit', 10)))
+        ]
+        return {'query': {'pages': pages}}
+
+
+def synthetic_joins(joins: int, chats: int, rate: float) -> list[dict]:
+    """
+    :param rate: Joins per minute, spread evenly
+    """
+    stream = []
+    for i in range(joins):
+        chat_id = -1001000000000 - i % chats
+        user_id = 2000000 + i
+        stream.append({
+            'at': i * 60 / rate,
+            'update': {
+                'update_id': i,
+                'chat_member': {
+                    'chat': chat(chat_id),
+                    'from': user(user_id),
+                    'date': 0,
+                    'old_chat_member': {'user': user(user_id), 'status': 'left'},
+                    'new_chat_member': {'user': user(user_id), 'status': 'member'}
+                }
+            }
+        })
+    return stream
+
+
+class Clicker:
+    """
+    Clicks a button of some of the CAPTCHAs after a random delay, from a single thread.
+    """
+
+    def __init__(self, accept, signer, click_rate: float, correct_rate: float, delay: tuple[float, float]):
+        self._accept = accept
+        self._signer = signer
+        self.click_rate = click_rate
+        self.correct_rate = correct_rate
+        self.delay = delay
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.clicked: dict[tuple[int, int], float] = {}
+        self.pending = 0
+
+    def captcha_sent(self, user_id: int, message: dict, callback_data: list[str]):
+        if not callback_data or random.random() >= self.click_rate:
+            return
+        chat_id = message['chat']['id']
+        # now=0: the buttons are not expired yet when the harness reads them
+        correct = [data for data in callback_data if self._signer.verify(chat_id, data, now=0).correct]
+        wrong = [data for data in callback_data if data not in correct]
+        data = random.choice(correct if random.random() < self.correct_rate or not wrong else wrong)
+        query = {
+            'update_id': 0,
+            'callback_query': {
+                'id': str(next(self._seq)),
+                'from': user(user_id),
+                'message': message,
+                'chat_instance': str(chat_id),
+                'data': data
+            }
+        }
+        with self._cond:
+            self.pending += 1
+            heapq.heappush(self._heap, (time.monotonic() + random.uniform(*self.delay), next(self._seq), query))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, query = heapq.heappop(self._heap)
+            message = query['callback_query']['message']
+            self.clicked[(message['chat']['id'], message['message_id'])] = time.monotonic()
+            self._accept(query)
+            with self._cond:
+                self.pending -= 1
+
+
+class Sampler:
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.max_threads = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.max_threads = max(self.max_threads, threading.active_count())
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def max_rss_mb() -> float:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 if sys.platform != 'darwin' else rss / 1024 / 1024
+
+
+def load_bot(workdir: str, args):
+    """
+    Import main.py with a config for the load test written to `workdir`, and Telegram and Wikisource faked.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, 'config_example.json'), encoding='utf-8') as f:
+        config = json.load(f)
+    config['token'] = '0:load-test'
+    config['timeout'] = args.timeout
+    config['asyncio'] = args.asyncio
+    config['record'] = os.path.join(workdir, 'record.json')
+    config['record_db'] = os.path.join(workdir, 'record.sqlite3')
+    config['state'] = {'backend': args.state, 'path': os.path.join(workdir, 'state.sqlite3')}
+    config['text_corpus'] = ''
+    config['webhook']['enable'] = False
+    config['whitelist'] = []
+    config['blacklist'] = []
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    with open(config['record'], 'w', encoding='utf-8') as f:
+        json.dump({}, f)
+
+    telegram = FakeTelegram(latency=args.api_latency)
+    catbot.Bot.api = lambda bot, action, data=None: telegram.api(action, data)
+    wikisource = FakeWikisource(latency=args.wiki_latency)
+    TextReadingChallenge._site = wikisource
+
+    os.chdir(workdir)
+    sys.path.insert(0, root)
+    import main
+    return main, telegram, wikisource
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='captcha-load-')
+    cwd = os.getcwd()
+    try:
+        main, telegram, wikisource = load_bot(workdir, args)
+        report(main, telegram, wikisource, args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(main, telegram: FakeTelegram, wikisource: FakeWikisource, args):
+    bot = main.bot
+    server = WebhookServer(bot, port=0, queue_size=100000, workers=args.workers)
+
+    if args.replay:
+        with open(args.replay, encoding='utf-8') as f:
+            stream = [json.loads(line) for line in f if line.strip()]
+    else:
+        stream = synthetic_joins(args.joins, args.chats, args.rate)
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                for item in stream:
+                    f.write(json.dumps(item) + '\n')
+
+    joined: dict[int, float] = {}
+    captcha_latency: list[float] = []
+    resolved: dict[tuple[int, int], float] = {}
+    lock = threading.Lock()
+    clicker = Clicker(server.accept, bot.callback_signer, args.click_rate, args.correct_rate, (1, args.max_think))
+
+    def on_captcha(user_id: int, message: dict, callback_data: list[str]):
+        now = time.monotonic()
+        with lock:
+            start = joined.pop(user_id, None)
+            if start is not None:
+                captcha_latency.append(now - start)
+        clicker.captcha_sent(user_id, message, callback_data)
+
+    def on_edit(chat_id: int, msg_id: int):
+        key = (chat_id, msg_id)
+        if key in clicker.clicked and key not in resolved:
+            resolved[key] = time.monotonic() - clicker.clicked[key]
+
+    telegram.on_captcha = on_captcha
+    telegram.on_edit = on_edit
+    sampler = Sampler()
+    threading.Thread(target=sampler.run, name='sampler', daemon=True).start()
+    threading.Thread(target=clicker.run, name='clicker', daemon=True).start()
+    bot.text_source.start()
+    time.sleep(args.warmup)
+    server.start()
+    calls_before = Counter(telegram.calls)
+
+    joins = 0
+    start = time.monotonic()
+    for item in stream:
+        delay = start + item['at'] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        update = item['update']
+        for update_type in ('chat_member', 'message'):
+            if update_type in update:
+                update[update_type]['date'] = int(time.time())
+        if 'chat_member' in update:
+            joins += 1
+            with lock:
+                joined[update['chat_member']['new_chat_member']['user']['id']] = time.monotonic()
+        server.accept(update)
+    server.join()
+    handled = time.monotonic()
+    while clicker.pending:
+        time.sleep(0.1)
+    server.join()
+    # Let the challenges nobody clicked time out and be failed
+    deadline = time.monotonic() + args.timeout + 60
+    while (len(Timeout.registry) or main.failures.stats()['pending']) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    server.join()
+    sampler.stop()
+    server.shutdown()
+
+    calls = telegram.calls - calls_before
+    total_calls = sum(calls.values())
+    print(f'joins: {joins} in {handled - start:.1f} s, {joins / (handled - start):.1f} joins/s handled, '
+          f'{len(captcha_latency)} CAPTCHAs sent')
+    print('join to CAPTCHA (ms): ' + ', '.join(
+        f'p{p} {percentile(captcha_latency, p) * 1e3:.0f}' for p in (50, 90, 99)
+    ) + f', max {max(captcha_latency, default=float("nan")) * 1e3:.0f}')
+    clicks = list(resolved.values())
+    print(f'click to result (ms), {len(clicks)} clicks: ' + ', '.join(
+        f'p{p} {percentile(clicks, p) * 1e3:.0f}' for p in (50, 90, 99)
+    ))
+    print(f'API calls: {total_calls}, {total_calls / joins if joins else 0:.2f} per join')
+    for method, count in calls.most_common():
+        print(f'  {method:<24} {count:>7} {count / joins if joins else 0:>7.2f}/join')
+    print(f'Wikisource queries: {wikisource.queries}, text pool: {bot.text_source.stats()}')
+    print(f'peak threads: {sampler.max_threads}, max RSS: {Sampler.max_rss_mb():.0f} MB')
+    print(f'webhook: {server.stats()}')
+    print(f'outbound: {bot.outbound.stats()}')
+    print(f'scheduler: {bot.scheduler.stats()}')
+    for kind in bot.scheduler.kinds():
+        print(f'  {kind:<12} {bot.scheduler.stats(kind)}')
+    print(f'expired: {main.failures.stats()}, callback rejects: {bot.callback_signer.stats()}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--joins', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=1000, help='joins per minute')
+    parser.add_argument('--replay', help='JSON lines of {"at": seconds, "update": update} to replay')
+    parser.add_argument('--save', help='save the synthetic stream for --replay')
+    parser.add_argument('--timeout', type=int, default=30, help='CAPTCHA timeout in seconds')
+    parser.add_argument('--click-rate', type=float, default=0.8, help='share of users clicking a button')
+    parser.add_argument('--correct-rate', type=float, default=0.9, help='share of clicks on the right answer')
+    parser.add_argument('--max-think', type=float, default=5, help='longest delay before a click, in seconds')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds per Telegram API call')
+    parser.add_argument('--wiki-latency', type=float, default=0.2, help='seconds per Wikisource query')
+    parser.add_argument('--workers', type=int, default=16, help='webhook worker threads')
+    parser.add_argument('--state', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--asyncio', action='store_true')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds for the text pool to fill before starting')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run(parse_args())
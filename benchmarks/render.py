@@ -0,0 +1,96 @@
+"""
+Compare the per-join rendering of the CAPTCHA message and keyboard in new_member, as formerly done from the raw
+config with one sign() call per button, with LanguageTemplates and sign_choices().
+
+Run from the repository root: python -m benchmarks.render
+"""
+import json
+import timeit
+
+import catbot
+from catbot.util import html_escape
+
+from callback_data import CallbackSigner
+from challenge import MathChallenge
+from templates import TemplateCache
+
+CHAT_ID = -1001234567890
+USER_ID = 123456789
+NAME = 'Alice <Wonderland>'
+TIMEOUT = 180
+EXPIRY = 2000000000
+
+
+def old_render(config: dict, signer: CallbackSigner, problem, language: str, is_flooding: bool):
+    challenge_id = signer.new_challenge_id()
+    button_list: list[list[catbot.InlineKeyboardButton]] = []
+    answer_list: list[catbot.InlineKeyboardButton] = []
+    for i in range(6):
+        answer_list.append(catbot.InlineKeyboardButton(
+            text=problem.choices()[i],
+            callback_data=signer.sign(CHAT_ID, challenge_id, USER_ID, i, EXPIRY,
+                                      problem.choices()[i] == problem.ans())
+        ))
+    button_list.append(answer_list)
+    button_list.append([
+        catbot.InlineKeyboardButton(
+            text=config['messages'][language]['manually_approve'],
+            callback_data=f'{USER_ID}_approve'
+        ),
+        catbot.InlineKeyboardButton(
+            text=config['messages'][language]['manually_reject'],
+            callback_data=f'{USER_ID}_reject'
+        )
+    ])
+    buttons = catbot.InlineKeyboard(button_list)
+    text = config['messages'][language]['new_member'].format(
+        user_id=USER_ID,
+        name=html_escape(NAME),
+        timeout=config['timeout'],
+        challenge=problem.qus()
+    )
+    if is_flooding:
+        text += '\n\n' + config['messages'][language]['flood_detected']
+    return text, buttons
+
+
+def new_render(cache: TemplateCache, signer: CallbackSigner, problem, language: str, is_flooding: bool):
+    templates = cache.get(language)
+    choices = problem.choices()
+    callback_data = signer.sign_choices(CHAT_ID, signer.new_challenge_id(), USER_ID, EXPIRY, choices, problem.ans())
+    buttons = templates.challenge_keyboard(USER_ID, choices, callback_data)
+    text = templates.render(
+        'new_member',
+        is_flooding,
+        user_id=USER_ID,
+        name=html_escape(NAME),
+        timeout=TIMEOUT,
+        challenge=problem.qus()
+    )
+    return text, buttons
+
+
+def main():
+    with open('config_example.json', encoding='utf-8') as f:
+        config = json.load(f)
+    config['timeout'] = TIMEOUT
+    signer = CallbackSigner(b'benchmark')
+    cache = TemplateCache(lambda: config)
+    problem = MathChallenge()
+    number = 10000
+
+    print(f'{"language":>8} {"flooding":>8} {"old (us/join)":>14} {"new (us/join)":>14} {"speedup":>8}')
+    for language in config['messages']:
+        for is_flooding in (False, True):
+            old_text, _ = old_render(config, signer, problem, language, is_flooding)
+            new_text, _ = new_render(cache, signer, problem, language, is_flooding)
+            assert old_text == new_text
+            old = min(timeit.repeat(lambda: old_render(config, signer, problem, language, is_flooding),
+                                    number=number, repeat=5)) / number
+            new = min(timeit.repeat(lambda: new_render(cache, signer, problem, language, is_flooding),
+                                    number=number, repeat=5)) / number
+            print(f'{language:>8} {str(is_flooding):>8} {old * 1e6:>14.2f} {new * 1e6:>14.2f} {old / new:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
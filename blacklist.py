@@ -0,0 +1,100 @@
+import logging
+import re
+import threading
+
+_REGEX_CHARS = set('.^$*+?{}[]\\|()')
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+def _trie_regex(node: dict) -> str:
+    if '' in node:    # a shorter literal already matches, the rest of the branch is irrelevant
+        return ''
+    alternatives = [re.escape(char) + _trie_regex(child) for char, child in sorted(node.items())]
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return '(?:' + '|'.join(alternatives) + ')'
+
+
+def literal_regex(literals: list[str]) -> str:
+    """
+    Build a regex matching any of the literals, with common prefixes merged into a trie so the regex engine does
+    not try every literal at every position.
+    """
+    trie: dict = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _trie_regex(trie)
+
+
+def _can_wrap(pattern: str) -> bool:
+    try:
+        re.compile(f'(?:{pattern})')
+    except re.error:    # e.g. global flags, which must stay at the start of the pattern
+        return False
+    return True
+
+
+class BlacklistMatcher:
+    """
+    Blacklist patterns compiled once into as few regexes as possible. Literal patterns are merged into a trie regex,
+    other patterns into one alternation. Patterns that cannot be combined safely, e.g. those using backreferences or
+    global flags, are kept as separate regexes.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = tuple(patterns)
+        literals = []
+        combinable = []
+        self._regexes: list[re.Pattern] = []
+        for pattern in self.patterns:
+            try:
+                compiled = re.compile(pattern)
+            except re.error as e:
+                logging.warning(f'Ignoring invalid blacklist pattern {pattern!r}: {e}')
+                continue
+            if not _REGEX_CHARS.intersection(pattern):
+                literals.append(pattern)
+            elif _BACKREFERENCE.search(pattern) or not _can_wrap(pattern):
+                self._regexes.append(compiled)
+            else:
+                combinable.append(pattern)
+
+        alternatives = []
+        if literals:
+            alternatives.append(literal_regex(literals))
+        alternatives.extend(f'(?:{pattern})' for pattern in combinable)
+        if alternatives:
+            try:
+                self._regexes.insert(0, re.compile('|'.join(alternatives)))
+            except re.error:
+                if literals:
+                    self._regexes.insert(0, re.compile(alternatives[0]))
+                self._regexes.extend(re.compile(pattern) for pattern in combinable)
+
+    def match(self, tokens: list[str]) -> bool:
+        for regex in self._regexes:
+            for token in tokens:
+                if regex.search(token):
+                    return True
+        return False
+
+
+_matcher = BlacklistMatcher([])
+_matcher_lock = threading.Lock()
+
+
+def matcher_for(patterns: list[str]) -> BlacklistMatcher:
+    """
+    Return a matcher for `patterns`, rebuilding the shared one only when the patterns changed.
+    """
+    global _matcher
+    matcher = _matcher
+    if matcher.patterns != tuple(patterns):
+        with _matcher_lock:
+            if _matcher.patterns != tuple(patterns):
+                _matcher = BlacklistMatcher(patterns)
+            matcher = _matcher
+    return matcher
@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+CHALLENGE_PREFIX = 'c:'
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while True:
+        number, digit = divmod(number, 36)
+        text = digits[digit] + text
+        if number == 0:
+            return text
+
+
+class ChallengeClick:
+    def __init__(self, challenge_id: str, user_id: int, choice: int, expiry: int, correct: bool,
+                 expired: bool = False):
+        self.challenge_id = challenge_id
+        self.user_id = user_id
+        self.choice = choice
+        self.expiry = expiry
+        self.correct = correct
+        self.expired = expired
+
+
+class CallbackSigner:
+    """
+    Sign the callback data of challenge buttons, so a click is validated without looking anything up.
+
+    The data reads `c:<challenge id>:<user id>:<choice>:<expiry>:<tag>`. Whether the choice is correct is not in the
+    data but covered by the tag, an HMAC which also covers the chat id. Without the key, the buttons of a challenge
+    look alike, and the verifier tells a correct choice from a wrong one by checking the tag for both.
+    """
+
+    def __init__(self, key: bytes, tag_size: int = 12):
+        """
+        :param tag_size: Bytes of HMAC kept in the data. 12 bytes keep the data well under Telegram's 64 bytes.
+        """
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+        self.tag_size = tag_size
+
+        self.forged = 0
+        self.expired = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'CallbackSigner':
+        """
+        Use `callback_secret` as the key, or derive one from the bot token if it is not set.
+        """
+        secret = config.get('callback_secret', '')
+        if secret:
+            return cls(secret.encode())
+        return cls(hashlib.sha256(b'callback_data:' + config['token'].encode()).digest())
+
+    @staticmethod
+    def new_challenge_id() -> str:
+        return _b64(os.urandom(6))
+
+    def _tag(self, chat_id: int, payload: str, correct: bool) -> str:
+        # Copying the keyed state skips hashing the key again
+        mac = self._hmac.copy()
+        mac.update(f'{chat_id}:{payload}:{int(correct)}'.encode())
+        return _b64(mac.digest()[:self.tag_size])
+
+    def sign(self, chat_id: int, challenge_id: str, user_id: int, choice: int, expiry: int, correct: bool) -> str:
+        """
+        :param expiry: Unix time after which the button is refused
+        """
+        payload = f'{challenge_id}:{user_id}:{choice}:{_base36(expiry)}'
+        return f'{CHALLENGE_PREFIX}{payload}:{self._tag(chat_id, payload, correct)}'
+
+    def sign_choices(self, chat_id: int, challenge_id: str, user_id: int, expiry: int, choices: list[str],
+                     answer: str) -> list[str]:
+        """
+        Sign the buttons of all choices of a challenge.
+        """
+        expiry_text = _base36(expiry)
+        data = []
+        for i, choice in enumerate(choices):
+            payload = f'{challenge_id}:{user_id}:{i}:{expiry_text}'
+            data.append(f'{CHALLENGE_PREFIX}{payload}:{self._tag(chat_id, payload, choice == answer)}')
+        return data
+
+    def verify(self, chat_id: int, data: str, now: float | None = None) -> ChallengeClick | None:
+        """
+        :return: The click, or None if the data is forged or malformed. An expired click is returned with `expired`
+            set, so that it can be refused with a message.
+        """
+        if not data.startswith(CHALLENGE_PREFIX):
+            self.forged += 1
+            return None
+        payload, _, tag = data[len(CHALLENGE_PREFIX):].rpartition(':')
+        # Check both tags whatever the first gives, so the time taken does not depend on the answer
+        tag = tag.encode()
+        correct = hmac.compare_digest(tag, self._tag(chat_id, payload, True).encode())
+        wrong = hmac.compare_digest(tag, self._tag(chat_id, payload, False).encode())
+        if not correct and not wrong:
+            self.forged += 1
+            return None
+
+        try:
+            challenge_id, user_id, choice, expiry = payload.split(':')
+            click = ChallengeClick(challenge_id, int(user_id), int(choice), int(expiry, 36), correct)
+        except ValueError:     # signed by us, but not as a challenge button
+            self.forged += 1
+            return None
+        if (time.time() if now is None else now) > click.expiry:
+            self.expired += 1
+            click.expired = True
+        return click
+
+    def stats(self) -> dict:
+        return {
+            'forged': self.forged,
+            'expired': self.expired
+        }
@@ -1,10 +1,14 @@
 from abc import ABC, abstractmethod
+import collections
 import random
 import re
+import threading
 
 from catbot.util import html_escape
 import mwclient
 import humanize
+import requests
+from requests.adapters import HTTPAdapter
 
 
 class Challenge(ABC):
@@ -27,6 +31,13 @@ class Challenge(ABC):
     def choices(self):
         return self._choices
 
+    @classmethod
+    def batch(cls, count: int, *args, **kwargs) -> list['Challenge']:
+        """
+        Generate `count` challenges. Subclasses may override this with something faster than one new() per challenge.
+        """
+        return [cls(*args, **kwargs) for _ in range(count)]
+
 
 class MathChallenge(Challenge):
     """
@@ -75,15 +86,67 @@ class MathChallenge(Challenge):
         self._ans = ans
         self._choices = choices
 
+    @classmethod
+    def batch(cls, count: int, rng: random.Random | None = None) -> list['MathChallenge']:
+        """
+        Generate `count` challenges in one pass, for prefilling a pool or for load tests. The problems are drawn as in
+        new(), but every draw is a single rng.random() call and the objects are filled in without going through
+        __init__. The answer is placed among 5 distinct other numbers below 100, at a random slot but never the first.
+        """
+        rand = (rng if rng is not None else random).random
+        new = object.__new__
+        operations = ('+', '-', '×', '÷')
+        challenges = []
+        for _ in range(count):
+            operation = operations[int(rand() * 4)]
+            if operation == '+' or operation == '-':
+                a, b = int(rand() * 51), int(rand() * 51)
+                if a < b:
+                    a, b = b, a
+                ans = a + b if operation == '+' else a - b
+            elif operation == '×':
+                a, b = int(rand() * 10), int(rand() * 10)
+                ans = a * b
+            else:
+                ans, b = int(rand() * 10), 1 + int(rand() * 9)
+                a = ans * b
+
+            seen = {ans}
+            choices = []
+            while len(choices) < 5:
+                choice = int(rand() * 100)
+                if choice not in seen:
+                    seen.add(choice)
+                    choices.append(choice)
+            choices.insert(1 + int(rand() * 5), ans)
+
+            challenge = new(cls)
+            challenge._a, challenge._b = a, b
+            challenge._op = operation
+            challenge._ans = ans
+            challenge._choices = choices
+            challenges.append(challenge)
+        return challenges
+
     def qus(self):
         return self.__str__()
 
 
 class TextReadingChallenge(Challenge):
-    def __init__(self, qus_template: str, language: str, user_agent: str = 'TextReadingChallenger/1.0'):
+    _site: mwclient.Site | None = None
+    _site_lock = threading.Lock()
+    _batch: collections.deque[str] = collections.deque()
+    _batch_lock = threading.Lock()
+    # Ordinals of 1 to 10, the range of ans_index, per language
+    _ordinals: dict[str, tuple[str, ...]] = {}
+    _ordinals_lock = threading.Lock()
+
+    def __init__(self, qus_template: str, language: str, user_agent: str = 'TextReadingChallenger/1.0',
+                 text: str | None = None):
         """
         :param qus_template: Template message for question. Use string prepared for str.format() method.
                              Required arguments are {text} and {index}
+        :param text: Prepared challenge text, e.g. from a TextPool. A random Wikisource article is fetched if omitted.
         """
         self._text = ''
         self.ans_index = 0
@@ -91,26 +154,73 @@ class TextReadingChallenge(Challenge):
         self._ans = ''
         self._choices: list[str] = []
         self._language = language
-        self.site = mwclient.Site('zh.wikisource.org', clients_useragent=user_agent)
-        self.new()
+        self._user_agent = user_agent
+        if text is None:
+            self.new()
+        else:
+            self.new_from_text(text)
 
     def new(self):
-        while True:     # Get new random article if the current one has too few han chars
-            random_title = next(self.site.random(0, api_chunk_size=1))['title']
-            api_payload = {
-                "format": "json",
-                "prop": "extracts",
-                "titles": random_title,
-                "utf8": 1,
-                "formatversion": "2",
-                "exintro": 1,
-                "explaintext": 1
-            }
-            challenge_text = self.site.api('query', **api_payload)['query']['pages'][0]['extract'][:50]
+        self.new_from_text(TextReadingChallenge.fetch_text(TextReadingChallenge.shared_site(self._user_agent)))
+
+    @classmethod
+    def shared_site(cls, user_agent: str, pool_size: int = 16) -> mwclient.Site:
+        """
+        Return the Wikisource site shared by all challenges. It is created on first use, and its HTTP session keeps
+        connections alive, so later requests skip the TLS handshake and siteinfo query.
+        """
+        with cls._site_lock:
+            if cls._site is None:
+                session = requests.Session()
+                session.headers['User-Agent'] = user_agent
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                cls._site = mwclient.Site('zh.wikisource.org', pool=session, clients_useragent=user_agent)
+            return cls._site
+
+    @classmethod
+    def reset_site(cls):
+        with cls._site_lock:
+            cls._site = None
+
+    @staticmethod
+    def fetch_texts(site: mwclient.Site, count: int = 10) -> list[str]:
+        """
+        Fetch intros of `count` random articles in a single query and return those with enough han chars.
+        """
+        api_payload = {
+            "format": "json",
+            "generator": "random",
+            "grnnamespace": 0,
+            "grnlimit": count,
+            "prop": "extracts",
+            "utf8": 1,
+            "formatversion": "2",
+            "exintro": 1,
+            "explaintext": 1,
+            "exlimit": count
+        }
+        texts = []
+        for page in site.api('query', **api_payload)['query']['pages']:
+            challenge_text = page.get('extract', '')[:50]
             challenge_text = re.sub(r'\s', '', challenge_text)    # remove whitespace characters
-            han = re.sub(r'[^\u4e00-\u9fff]', '', challenge_text)    # remove non han characters
-            if len(han) > 10:
-                break
+            if TextReadingChallenge.usable(challenge_text):
+                texts.append(challenge_text)
+        return texts
+
+    @classmethod
+    def fetch_text(cls, site: mwclient.Site) -> str:
+        with cls._batch_lock:
+            while not cls._batch:   # Get new random articles if the current ones have too few han chars
+                cls._batch.extend(cls.fetch_texts(site))
+            return cls._batch.popleft()
+
+    @staticmethod
+    def usable(challenge_text: str) -> bool:
+        return len(re.sub(r'[^\u4e00-\u9fff]', '', challenge_text)) > 10
+
+    def new_from_text(self, challenge_text: str):
+        han = re.sub(r'[^\u4e00-\u9fff]', '', challenge_text)    # remove non han characters
 
         self.ans_index = random.randint(1, 10)
         self._ans = han[self.ans_index - 1]
@@ -134,8 +244,19 @@ class TextReadingChallenge(Challenge):
             index=TextReadingChallenge.ordinal(self.ans_index, self._language)
         )
 
+    @classmethod
+    def prepare_ordinals(cls, languages: list[str]):
+        """
+        Render the ordinals of each language once, so ordinal() is a table lookup. humanize translates through a
+        process-wide locale, which is only switched here, under a lock.
+        """
+        with cls._ordinals_lock:
+            for language in languages:
+                if language not in cls._ordinals:
+                    cls._ordinals[language] = tuple(cls._render_ordinal(number, language) for number in range(1, 11))
+
     @staticmethod
-    def ordinal(number: int, language: str) -> str:
+    def _render_ordinal(number: int, language: str) -> str:
         if language.startswith('zh'):
             return str(number)
         elif language == 'en':
@@ -143,4 +264,18 @@ class TextReadingChallenge(Challenge):
             return humanize.ordinal(number)
         else:
             humanize.activate(language)
-            return humanize.ordinal(number)
+            try:
+                return humanize.ordinal(number)
+            finally:
+                humanize.deactivate()
+
+    @classmethod
+    def ordinal(cls, number: int, language: str) -> str:
+        ordinals = cls._ordinals.get(language)
+        if ordinals is None:
+            cls.prepare_ordinals([language])
+            ordinals = cls._ordinals[language]
+        if 1 <= number <= len(ordinals):
+            return ordinals[number - 1]
+        with cls._ordinals_lock:
+            return cls._render_ordinal(number, language)
@@ -0,0 +1,107 @@
+import array
+import mmap
+import os
+import random
+import re
+import sys
+import threading
+
+from challenge import TextReadingChallenge
+
+PASSAGE_LENGTH = 50
+
+
+def build_index(corpus_path: str, index_path: str) -> int:
+    """
+    Scan a UTF-8 text corpus (e.g. plain text extracted from a Wikisource dump) and write the byte offset and length of
+    every passage usable by TextReadingChallenge. A passage is a run of at most PASSAGE_LENGTH non-whitespace
+    characters within one line.
+    :return: Number of indexed passages
+    """
+    index = array.array('Q')
+    offset = 0
+    with open(corpus_path, 'rb') as f:
+        for line in f:
+            text = line.decode('utf-8', errors='surrogateescape')
+            start = 0
+            position = offset
+            while start < len(text):
+                end = start
+                count = 0
+                while end < len(text) and count < PASSAGE_LENGTH:
+                    if not text[end].isspace():
+                        count += 1
+                    end += 1
+                passage = text[start:end]
+                size = len(passage.encode('utf-8', errors='surrogateescape'))
+                if TextReadingChallenge.usable(re.sub(r'\s', '', passage)):
+                    index.append(position)
+                    index.append(size)
+                position += size
+                start = end
+            offset += len(line)
+
+    with open(index_path, 'wb') as f:
+        index.tofile(f)
+    return len(index) // 2
+
+
+class TextCorpus:
+    """
+    Challenge texts sampled from a local corpus instead of Wikisource. The corpus and its passage index are
+    memory-mapped, so taking a text is a random index lookup and a slice of the mapped file.
+    """
+
+    def __init__(self, corpus_path: str, index_path: str | None = None):
+        self.corpus_path = corpus_path
+        self.index_path = index_path if index_path is not None else corpus_path + '.idx'
+        self._lock = threading.Lock()
+        self._corpus: mmap.mmap | None = None
+        self._index_map: mmap.mmap | None = None
+        self._index: memoryview | None = None
+        self._count = 0
+
+        self.served = 0
+
+    def start(self):
+        with self._lock:
+            if self._index is not None:
+                return
+            if not os.path.exists(self.index_path) or \
+                    os.path.getmtime(self.index_path) < os.path.getmtime(self.corpus_path):
+                build_index(self.corpus_path, self.index_path)
+            if os.path.getsize(self.index_path) == 0:
+                raise ValueError(f'No usable passage in corpus {self.corpus_path}')
+
+            with open(self.corpus_path, 'rb') as f:
+                self._corpus = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.index_path, 'rb') as f:
+                self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = len(self._index_map) // 16
+            self._index = memoryview(self._index_map).cast('Q')
+
+    def get(self) -> str:
+        if self._index is None:
+            self.start()
+        i = random.randrange(self._count)
+        offset, length = self._index[2 * i], self._index[2 * i + 1]
+        self.served += 1
+        return re.sub(r'\s', '', self._corpus[offset:offset + length].decode('utf-8', errors='ignore'))
+
+    def __len__(self):
+        return self._count
+
+    def stats(self) -> dict:
+        return {
+            'passages': self._count,
+            'served': self.served
+        }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <corpus file> [index file]')
+        sys.exit(1)
+    corpus_file = sys.argv[1]
+    index_file = sys.argv[2] if len(sys.argv) > 2 else corpus_file + '.idx'
+    print(f'{build_index(corpus_file, index_file)} passages indexed')
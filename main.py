@@ -1,15 +1,27 @@
-import re
-import threading
+import asyncio
 import time
 import logging
 from collections import defaultdict
 
 import catbot
+import requests
 from catbot.util import html_escape
 
 from challenge import Challenge, TextReadingChallenge, MathChallenge
-from anti_flood import AntiFlood
-from timeout import Timeout
+from anti_flood import AntiFlood, CounterEditQueue
+from timeout import Timeout, Scheduler, ChatBatcher
+from text_pool import TextPool
+from corpus import TextCorpus
+from blacklist import matcher_for
+from aio import AsyncRunner
+from cache import TTLCache
+from webhook import WebhookServer
+from routing import ChatRouter
+from record_store import RecordStore, RecordDatabase
+from state import ChallengeRecord, create_backend
+from callback_data import CallbackSigner, CHALLENGE_PREFIX
+from templates import TemplateCache
+from outbound import OutboundLimiter, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 
 class CaptchaBot(catbot.Bot):
@@ -18,83 +30,323 @@ class CaptchaBot(catbot.Bot):
 
         self.anti_flood_period: int = int(self.config['anti_flood']['period'])
         self.anti_flood_count: int = int(self.config['anti_flood']['count'])
+        # Join counts per period to enable and disable anti-flood automatically, 0 to turn off
+        self.anti_flood_auto_enable: int = int(self.config['anti_flood'].get('auto_enable_count', 0))
+        self.anti_flood_auto_disable: int = int(self.config['anti_flood'].get('auto_disable_count', 0))
+
+        # Pending challenges and join counts, shared with the other bot processes when there are several
+        self.state = create_backend(self.config.get('state', {}), self.anti_flood_period, self.anti_flood_count)
+        self.router = ChatRouter.from_config(self)
+        self.callback_signer = CallbackSigner.from_config(self.config)
+        self.templates = TemplateCache(lambda: self.config)
+        TextReadingChallenge.prepare_ordinals(self.config['languages'])
+        self.records = RecordStore(
+            lambda: self.record,
+            database=RecordDatabase(self.config['record_db']) if self.config.get('record_db') else None,
+            read_through=self.router.count > 1
+        )
 
-        self.flood_messages: defaultdict[str, list[catbot.ChatMemberUpdate]] = defaultdict(list)
         self.anti_floods: defaultdict[str, AntiFlood] = defaultdict(AntiFlood)
 
+        outbound_config = self.config.get('outbound', {})
+        self.outbound = OutboundLimiter(
+            global_rate=float(outbound_config.get('global_rate', 30)),
+            chat_rate=float(outbound_config.get('chat_rate', 20 / 60)),
+            chat_burst=float(outbound_config.get('chat_burst', 5)),
+            max_retries=int(outbound_config.get('max_retries', 3))
+        )
+
+        cache_config = self.config.get('cache', {})
+        self.chat_cache = TTLCache(maxsize=int(cache_config.get('size', 4096)),
+                                   ttl=float(cache_config.get('chat_ttl', 300)))
+        self.member_cache = TTLCache(maxsize=int(cache_config.get('size', 4096)),
+                                     ttl=float(cache_config.get('member_ttl', 60)))
+        self.admin_cache = TTLCache(maxsize=int(cache_config.get('size', 4096)),
+                                    ttl=float(cache_config.get('admin_ttl', 300)))
+
+        self.handlers: defaultdict[str, list] = defaultdict(list)
+        self.aio = AsyncRunner(
+            enabled=bool(self.config.get('asyncio', False)),
+            workers=int(self.config.get('async_workers', 32))
+        )
+
+        # Jobs making Telegram calls may wait for the outbound rate limiter, and run apart from challenge timers
+        self.scheduler = Scheduler(pools={'expire': 4, 'shorten': 2, 'counter_edit': 2, 'anti_flood': 2})
+        self.counter_edits = CounterEditQueue(
+            lambda chat_id, msg_id, text: self.edit_message(chat_id, msg_id, text=text, priority=PRIORITY_LOW),
+            self.scheduler,
+            interval=float(self.config['anti_flood'].get('edit_interval', 3))
+        )
+
+        self.text_source: TextPool | TextCorpus
+        if self.config.get('text_corpus'):
+            self.text_source = TextCorpus(self.config['text_corpus'])
+        else:
+            pool_config = self.config.get('text_pool', {})
+            self.text_source = TextPool(
+                self.config['user_agent'],
+                size=int(pool_config.get('size', 50)),
+                low_watermark=int(pool_config.get('low_watermark', 10))
+            )
+
+    # Handlers may be coroutines, see AsyncRunner. They are also listed in self.handlers by update type, for
+    # updates not received through catbot's long polling.
+
+    def msg_task(self, criteria):
+        return self._adapt_task('message', criteria, super().msg_task(criteria))
+
+    def query_task(self, criteria):
+        return self._adapt_task('callback_query', criteria, super().query_task(criteria))
+
+    def member_status_task(self, criteria):
+        return self._adapt_task('chat_member', criteria, super().member_status_task(criteria))
+
+    def _adapt_task(self, update_type: str, criteria, register):
+        def decorator(func):
+            handler = self.aio.adapt(func)
+            register(handler)
+            self.handlers[update_type].append((criteria, handler))
+            return func
+
+        return decorator
+
+    # Lookups are cached, and invalidated by member updates seen by the handlers
+
+    def get_chat(self, chat_id):
+        return self.chat_cache.get_or_load(chat_id, lambda: super(CaptchaBot, self).get_chat(chat_id))
+
+    def get_chat_member(self, chat_id, user_id):
+        return self.member_cache.get_or_load(
+            (chat_id, user_id),
+            lambda: super(CaptchaBot, self).get_chat_member(chat_id, user_id)
+        )
+
+    def get_chat_admins(self, chat_id) -> frozenset[int]:
+        return self.admin_cache.get_or_load(
+            chat_id,
+            lambda: frozenset(item['user']['id'] for item in self.api('getChatAdministrators', {'chat_id': chat_id}))
+        )
+
+    def is_admin(self, chat_id, user_id) -> bool:
+        return user_id in self.get_chat_admins(chat_id)
+
+    def invalidate_member(self, msg: catbot.ChatMemberUpdate):
+        self.member_cache.pop((msg.chat.id, msg.new_chat_member.id))
+        self.chat_cache.pop(msg.new_chat_member.id)
+        if {msg.old_chat_member.status, msg.new_chat_member.status} & {'administrator', 'creator'}:
+            self.admin_cache.pop(msg.chat.id)
+
+    # Outbound calls used by the handlers go through the rate limiter
+
+    def send_message(self, chat_id, *args, acquired: bool = False, **kwargs):
+        """
+        :param acquired: A token was already taken with outbound.acquire_async()
+        """
+        return self.outbound.call(chat_id, PRIORITY_NORMAL, super().send_message, chat_id, *args, new_message=True,
+                                  acquired=acquired, **kwargs)
+
+    def edit_message(self, chat_id, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        """
+        :param priority: PRIORITY_LOW for cosmetic edits, which yield to verdicts and new messages
+        """
+        return self.outbound.call(chat_id, priority, super().edit_message, chat_id, *args, **kwargs)
+
+    def delete_message(self, chat_id, *args, **kwargs):
+        return self.outbound.call(chat_id, PRIORITY_NORMAL, super().delete_message, chat_id, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self.outbound.call(None, PRIORITY_NORMAL, super().answer_callback_query, *args, **kwargs)
+
+    def silence_chat_member(self, chat_id, *args, **kwargs):
+        return self.outbound.call(chat_id, PRIORITY_HIGH, super().silence_chat_member, chat_id, *args, **kwargs)
+
+    def lift_and_preserve_restriction(self, chat_id, *args, **kwargs):
+        return self.outbound.call(chat_id, PRIORITY_HIGH, super().lift_and_preserve_restriction, chat_id,
+                                  *args, **kwargs)
+
+    def kick_chat_member(self, chat_id, *args, **kwargs):
+        return self.outbound.call(chat_id, PRIORITY_HIGH, super().kick_chat_member, chat_id, *args, **kwargs)
+
+    def delete_messages(self, chat_id, msg_ids: list[int]):
+        """
+        Delete messages of a chat, 100 per request.
+        """
+        for i in range(0, len(msg_ids), 100):
+            self.outbound.call(chat_id, PRIORITY_NORMAL, self.api, 'deleteMessages', {
+                'chat_id': chat_id,
+                'message_ids': msg_ids[i:i + 100]
+            })
+
 
 bot = CaptchaBot(config_path='config.json')
-t_lock = threading.Lock()
+scheduler = bot.scheduler
 
 
-def test_if_flooding(msg: catbot.ChatMemberUpdate) -> bool:
-    chat_id = msg.chat.id
-    current_time = msg.date
-    with t_lock:
-        for item in filter(lambda x: x.date < current_time - bot.anti_flood_period, bot.flood_messages[chat_id]):
-            bot.flood_messages[chat_id].remove(item)
-        bot.flood_messages[chat_id].append(msg)
-    return len(bot.flood_messages[chat_id]) >= bot.anti_flood_count
+def count_joins(msg: catbot.ChatMemberUpdate) -> int:
+    return bot.state.flood_hit(msg.chat.id, msg.date)
 
 
-def timeout_callback(chat_id: int, msg_id: int, user_id: int, is_flooding: bool):
-    language = get_chat_language(chat_id)
-    member = bot.get_chat_member(chat_id, user_id)
+def auto_enable_anti_flood(chat_id: int, language: str):
+    anti: AntiFlood = bot.anti_floods[chat_id]
+    with anti.lock:
+        if anti.enabled:
+            return
+        try:
+            sent = bot.send_message(chat_id, text=bot.config['messages'][language]['anti_flood_enabled'].format(num=0))
+        except catbot.APIError as e:
+            logging.info(e.args[0])
+            return
+        anti.enable(sent, auto=True)
+    scheduler.schedule('anti_flood', bot.anti_flood_period, auto_disable_anti_flood, chat_id)
+
+
+def count_anti_flood_join(chat_id: int, language: str):
+    """
+    Count a join silenced under anti-flood, and queue the edit of the counter message.
+    """
+    anti: AntiFlood = bot.anti_floods[chat_id]
+    with anti.lock:
+        if not anti.enabled:     # disabled and announced meanwhile
+            return
+        anti.counter += 1
+        text = bot.config['messages'][language]['anti_flood_enabled'].format(num=anti.counter)
+        # Pushed under the lock too, so the last text queued is the highest count
+        bot.counter_edits.push(chat_id, anti.msg_id, text)
+
+
+def auto_disable_anti_flood(chat_id: int):
+    """
+    Check an automatically enabled anti-flood once per period, and disable it when the join rate drops to
+    auto_disable_count. The gap between the two thresholds keeps it from flapping.
+    """
+    anti: AntiFlood = bot.anti_floods[chat_id]
+    with anti.lock:
+        if not anti.enabled or not anti.auto:
+            return
+        if bot.state.flood_recent(chat_id, time.time()) > bot.anti_flood_auto_disable:
+            scheduler.schedule('anti_flood', bot.anti_flood_period, auto_disable_anti_flood, chat_id)
+            return
+        anti.disable()
+        counter = anti.counter
+    bot.counter_edits.flush(chat_id)
+    announce_anti_flood_disabled(chat_id, get_chat_language(chat_id), counter)
+
+
+def announce_anti_flood_disabled(chat_id: int, language: str, counter: int):
     try:
-        text = bot.config['messages'][language]['challenge_failed'].format(
-            user_id=user_id,
-            name=member.name
-        )
-        if is_flooding:
-            text += '\n' + bot.config['messages'][language]['flood_detected']
-        bot.edit_message(
+        bot.send_message(
             chat_id,
-            msg_id,
-            text=text,
-            parse_mode='HTML'
+            text=bot.config['messages'][language]['anti_flood_disabled'].format(num=counter)
         )
-    except catbot.MessageNotFoundError:
-        pass
+    except catbot.APIError as e:
+        logging.info(e.args[0])
+
+
+def timeout_callback(chat_id: int, msg_id: int, user_id: int, is_flooding: bool):
+    challenge = bot.state.claim_challenge(chat_id, msg_id)
+    if challenge is None:     # resolved by another process
+        return
+    failures.push(chat_id, challenge)
+
+
+def challenge_user_name(challenge: ChallengeRecord) -> str:
+    if challenge.name:
+        return challenge.name
+    # Challenges recovered from an earlier version have no name
+    return bot.get_chat_member(challenge.chat_id, challenge.user_id).name
+
+
+def fail_challenges(chat_id: int, challenges: list[ChallengeRecord]):
+    """
+    Announce the challenges of a chat that expired within one batch interval. With `expire.mode` set to 'edit', each
+    CAPTCHA message is edited. With 'summary', they are deleted in bulk and replaced by one message listing the
+    users, and with 'delete' they are only deleted.
+    """
+    templates = bot.templates.get(get_chat_language(chat_id))
+    mode = bot.config.get('expire', {}).get('mode', 'edit')
+    if mode == 'edit' or mode == 'summary' and len(challenges) == 1:
+        for challenge in challenges:
+            text = templates.render(
+                'challenge_failed',
+                challenge.is_flooding,
+                user_id=challenge.user_id,
+                name=html_escape(challenge_user_name(challenge))
+            )
+            try:
+                bot.edit_message(
+                    chat_id,
+                    challenge.msg_id,
+                    text=text,
+                    parse_mode='HTML'
+                )
+            except catbot.MessageNotFoundError:
+                pass
+            except catbot.APIError as e:
+                logging.info(e.args[0])
+        return
+
+    try:
+        bot.delete_messages(chat_id, [challenge.msg_id for challenge in challenges])
+    except catbot.APIError as e:
+        logging.info(e.args[0])
+    if mode != 'summary':
+        return
+    # Keep each summary well under the message length limit
+    for i in range(0, len(challenges), 50):
+        chunk = challenges[i:i + 50]
+        text = templates.render(
+            'challenge_failed_summary',
+            any(challenge.is_flooding for challenge in chunk),
+            count=len(chunk),
+            users=', '.join(
+                f'<a href="tg://user?id={challenge.user_id}">{html_escape(challenge_user_name(challenge))}</a>'
+                for challenge in chunk
+            )
+        )
+        try:
+            bot.send_message(chat_id, text=text, parse_mode='HTML')
+        except catbot.APIError as e:
+            logging.info(e.args[0])
+
+
+failures = ChatBatcher(
+    fail_challenges,
+    scheduler,
+    interval=float(bot.config.get('expire', {}).get('batch_interval', 1)),
+    kind='expire'
+)
 
 
 def read_record_and_lift(chat_id: int, user_id: int):
-    with t_lock:
-        if 'restrict_record' in bot.record:
-            restrict_record = bot.record['restrict_record']
-        else:
-            restrict_record = {}
-    if str(chat_id) in restrict_record and str(user_id) in restrict_record[str(chat_id)]:
-        record = restrict_record[str(chat_id)][str(user_id)]
+    record = bot.records.get_restriction(chat_id, user_id)
+    if record is not None:
         restricted_until = record['until'] if record['restricted_by'] != bot.id else time.time()
         bot.lift_and_preserve_restriction(chat_id, user_id, int(restricted_until))
     else:
         bot.lift_and_preserve_restriction(chat_id, user_id, int(time.time()))
 
 
+def compact_records():
+    bot.records.database.compact()
+    scheduler.call_later(bot.config.get('record_compact_interval', 3600), compact_records)
+
+
+def prune_records():
+    bot.records.prune()
+    scheduler.call_later(bot.config.get('record_prune_interval', 600), prune_records)
+
+
 def get_chat_language(chat_id: int) -> str:
     """
     Return language setting of a chat. If the chat has no language setting then return the default 'en'.
     :param chat_id:
     :return:
     """
-    with t_lock:
-        if 'language' in bot.record:
-            chat_languages = bot.record['language']
-        else:
-            chat_languages = {}
-    if str(chat_id) in chat_languages:
-        return chat_languages[str(chat_id)]
-    else:
-        return 'en'
+    return bot.records.get_language(chat_id, 'en')
 
 
 def match_blacklist(tokens: list[str]) -> bool:
-    for reg in bot.config['blacklist']:
-        for token in tokens:
-            if re.search(reg, token):
-                return True
-
-    return False
+    return matcher_for(bot.config['blacklist']).match(tokens)
 
 
 def msg_contain_anti_flood_advice(msg: catbot.Message) -> bool:
@@ -139,136 +391,189 @@ def new_member_cri(msg: catbot.ChatMemberUpdate) -> bool:
         return False
 
 
+def new_challenge(language: str) -> Challenge:
+    challenge_text = bot.text_source.get()
+    # Fall back to a math problem if no prefetched text is ready
+    if challenge_text is None:
+        return MathChallenge()
+    template = bot.config['messages'][language]['text_reading_challenge']
+    return TextReadingChallenge(template, language, text=challenge_text)
+
+
 @bot.member_status_task(new_member_cri)
-def new_member(msg: catbot.ChatMemberUpdate):
-    try:
-        bot.silence_chat_member(msg.chat.id, msg.new_chat_member.id)
-        user_chat = bot.get_chat(msg.new_chat_member.id)
-        if int(msg.new_chat_member.id) not in bot.config['whitelist'] and \
-                match_blacklist([msg.new_chat_member.name, user_chat.bio if user_chat.bio is not None else '']):
-            bot.kick_chat_member(msg.chat.id, msg.new_chat_member.id)
+async def new_member(msg: catbot.ChatMemberUpdate):
+    bot.invalidate_member(msg)
+    chat_id = msg.chat.id
+    user_id = msg.new_chat_member.id
+    # Both may block on the state database, so they are kept off the event loop in asyncio mode
+    language, join_count = await asyncio.gather(
+        bot.aio.call(get_chat_language, chat_id),
+        bot.aio.call(count_joins, msg)
+    )
+    is_flooding = join_count >= bot.anti_flood_count
+    if bot.anti_flood_auto_enable and join_count >= bot.anti_flood_auto_enable \
+            and not bot.anti_floods[chat_id].enabled:
+        await bot.aio.call(auto_enable_anti_flood, chat_id, language)
+
+    if bot.anti_floods[chat_id].enabled:
+        # Under anti-flood only the restriction is applied, no bio lookup nor challenge
+        try:
+            await bot.aio.call(bot.silence_chat_member, chat_id, user_id)
+        except catbot.InsufficientRightError:
             return
-    except catbot.InsufficientRightError:
+        # The lock may be held by a thread sending a message, so it is not waited for on the event loop
+        await bot.aio.call(count_anti_flood_join, chat_id, language)
         return
 
-    chat_id = msg.chat.id
-    language = get_chat_language(msg.chat.id)
-    is_flooding = test_if_flooding(msg)
+    # These do not depend on each other
+    results = await asyncio.gather(
+        bot.aio.call(bot.silence_chat_member, chat_id, user_id),
+        bot.aio.call(bot.get_chat, user_id),
+        bot.aio.call(new_challenge, language),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, catbot.InsufficientRightError):
+            return
+        elif isinstance(result, BaseException):
+            raise result
+    _, user_chat, problem = results
 
-    if bot.anti_floods[chat_id].enabled:
-        bot.anti_floods[chat_id].counter += 1
-        text = bot.config['messages'][language]['anti_flood_enabled'].format(
-            num=bot.anti_floods[chat_id].counter
-        )
+    if int(user_id) not in bot.config['whitelist'] and \
+            match_blacklist([msg.new_chat_member.name, user_chat.bio if user_chat.bio is not None else '']):
         try:
-            bot.edit_message(chat_id, bot.anti_floods[chat_id].msg_id, text=text)
-        except catbot.APIError as e:
-            logging.info(e.args[0])
-    else:
-        template = bot.config['messages'][language]['text_reading_challenge']
-        user_agent = bot.config['user_agent']
-        # Randomly challenge user with a math or text reading problem
-        problem: Challenge = TextReadingChallenge(template, language, user_agent)
-        # problem: Challenge = MathChallenge()
-        button_list: list[list[catbot.InlineKeyboardButton]] = []
-        answer_list: list[catbot.InlineKeyboardButton] = []
-        for i in range(6):
-            if problem.choices()[i] == problem.ans():
-                answer_list.append(catbot.InlineKeyboardButton(
-                    text=problem.choices()[i],
-                    callback_data=f'{msg.new_chat_member.id}_correct'
-                ))
-            else:
-                answer_list.append(catbot.InlineKeyboardButton(
-                    text=problem.choices()[i],
-                    callback_data=f'{msg.new_chat_member.id}_wrong'
-                ))
-        button_list.append(answer_list)
-        button_list.append([
-            catbot.InlineKeyboardButton(
-                text=bot.config['messages'][language]['manually_approve'],
-                callback_data=f'{msg.new_chat_member.id}_approve'
-            ),
-            catbot.InlineKeyboardButton(
-                text=bot.config['messages'][language]['manually_reject'],
-                callback_data=f'{msg.new_chat_member.id}_reject'
-            )
-        ])
-        buttons = catbot.InlineKeyboard(button_list)
-        text = bot.config['messages'][language]['new_member'].format(
-            user_id=msg.new_chat_member.id,
-            name=html_escape(msg.new_chat_member.name),
-            timeout=bot.config['timeout'],
-            challenge=problem.qus()
-        )
-        if is_flooding:
-            text += '\n\n' + bot.config['messages'][language]['flood_detected']
+            await bot.aio.call(bot.kick_chat_member, chat_id, user_id)
+        except catbot.InsufficientRightError:
+            pass
+        return
+
+    templates = bot.templates.get(language)
+    challenge_id = bot.callback_signer.new_challenge_id()
+    # Sending may wait for the rate limiter, so the buttons stay valid `callback_grace` seconds longer than the
+    # challenge would last if sent at once. The challenge ends when they expire at the latest.
+    expiry = int(time.time()) + bot.config['timeout'] + int(bot.config.get('callback_grace', 300))
+    choices = problem.choices()
+    answer = problem.ans()
+    buttons = templates.challenge_keyboard(
+        user_id,
+        choices,
+        bot.callback_signer.sign_choices(chat_id, challenge_id, user_id, expiry, choices, answer)
+    )
+    text = templates.render(
+        'new_member',
+        is_flooding,
+        user_id=user_id,
+        name=html_escape(msg.new_chat_member.name),
+        timeout=bot.config['timeout'],
+        challenge=problem.qus()
+    )
 
+    try:
+        # Wait for the rate limits on the event loop rather than in a pool thread
+        await bot.outbound.acquire_async(chat_id, PRIORITY_NORMAL, new_message=True)
+        sent = await bot.aio.call(bot.send_message, chat_id, text=text, parse_mode='HTML', reply_markup=buttons,
+                                  acquired=True)
+    except (catbot.APIError, requests.RequestException) as e:
+        # Transient errors are already retried by the outbound limiter where it is safe. Without a CAPTCHA the user
+        # could never be let in, so the restriction is lifted.
+        logging.warning(f'Failed to send CAPTCHA to {user_id} in {chat_id}: {e}')
         try:
-            sent = bot.send_message(msg.chat.id, text=text, parse_mode='HTML', reply_markup=buttons)
+            await bot.aio.call(read_record_and_lift, chat_id, user_id)
         except catbot.APIError as e:
-            logging.info(e.args[0])
-            new_member(msg)  # rerun if any problem in sending
+            logging.warning(f'Failed to lift restriction on {user_id} in {chat_id}: {e.args[0]}')
+    else:
+        deadline = min(time.time() + bot.config['timeout'], expiry)
+        await bot.aio.call(bot.state.add_challenge, ChallengeRecord(
+            chat_id, sent.id, user_id, deadline, is_flooding, answer, msg.new_chat_member.name
+        ))
+        start_timeout(chat_id, sent.id, user_id, deadline - time.time(), is_flooding)
+
+
+def start_timeout(chat_id: int, msg_id: int, user_id: int, timer: float, is_flooding: bool):
+    timeout = Timeout(
+        chat_id=chat_id,
+        user_id=user_id,
+        msg_id=msg_id,
+        timer=timer
+    )
+    timeout.start(
+        scheduler,
+        timeout_callback,
+        chat_id=chat_id,
+        msg_id=msg_id,
+        user_id=user_id,
+        is_flooding=is_flooding
+    )
+
+
+def recover_challenges() -> tuple[int, int]:
+    """
+    Re-arm the timers of challenges left pending by the last run, and fail those that expired meanwhile. The expired
+    ones are failed in one batch per chat.
+    :return: Numbers of re-armed and expired challenges
+    """
+    now = time.time()
+    rearmed = 0
+    expired = 0
+    for challenge in bot.state.list_challenges():
+        if not bot.router.owns(challenge.chat_id) \
+                or Timeout.find_by_message(challenge.chat_id, challenge.msg_id) is not None:
+            continue
+        if challenge.deadline > now:
+            start_timeout(challenge.chat_id, challenge.msg_id, challenge.user_id, challenge.deadline - now,
+                          challenge.is_flooding)
+            rearmed += 1
         else:
-            timeout = Timeout(
-                chat_id=msg.chat.id,
-                user_id=msg.new_chat_member.id,
-                msg_id=sent.id,
-                timer=bot.config['timeout']
-            )
-            timeout_thread = threading.Thread(target=timeout.run, kwargs={
-                'callback': timeout_callback,
-                'chat_id': msg.chat.id,
-                'msg_id': sent.id,
-                'user_id': msg.new_chat_member.id,
-                'is_flooding': is_flooding
-            })
-            timeout_thread.start()
+            timeout_callback(challenge.chat_id, challenge.msg_id, challenge.user_id, challenge.is_flooding)
+            expired += 1
+    return rearmed, expired
 
 
 def challenge_button_cri(query: catbot.CallbackQuery):
-    return query.data.endswith('correct') or query.data.endswith('wrong')
+    return query.data.startswith(CHALLENGE_PREFIX)
 
 
 @bot.query_task(challenge_button_cri)
 def challenge_button(query: catbot.CallbackQuery):
-    language = get_chat_language(query.msg.chat.id)
-    query_token = query.data.split('_')
-    if len(query_token) != 2:
+    # Forged clicks are refused before any lookup
+    click = bot.callback_signer.verify(query.msg.chat.id, query.data)
+    if click is None:
         bot.answer_callback_query(query.id)
         return
-    try:
-        challenged_user_id = int(query_token[0])
-    except ValueError:
-        bot.answer_callback_query(query.id)
+    challenged_user_id = click.user_id
+    language = get_chat_language(query.msg.chat.id)
+    if query.from_.id != challenged_user_id:
+        bot.answer_callback_query(
+            query.id,
+            text=bot.config['messages'][language]['button_not_for_you'],
+            show_alert=True,
+            cache_time=bot.config['timeout']
+        )
         return
-    else:
-        if query.from_.id != challenged_user_id:
-            bot.answer_callback_query(
-                query.id,
-                text=bot.config['messages'][language]['button_not_for_you'],
-                show_alert=True,
-                cache_time=bot.config['timeout']
-            )
-            return
 
-    bot.answer_callback_query(query.id)
-    for timeout in Timeout.list_all():
-        if timeout.chat_id == query.msg.chat.id and timeout.msg_id == query.msg.id:
-            timeout.stop()
-            break
-    else:
+    # The state tells whether the challenge is still open. The signed expiry only bounds it, without a lookup.
+    challenge = None if click.expired else bot.state.claim_challenge(query.msg.chat.id, query.msg.id)
+    if challenge is None:
+        bot.answer_callback_query(
+            query.id,
+            text=bot.config['messages'][language]['challenge_ended'],
+            show_alert=True,
+            cache_time=bot.config['timeout']
+        )
         return
+    bot.answer_callback_query(query.id)
+    stop_timeout(query.msg.chat.id, query.msg.id)
 
-    challenged_user = bot.get_chat_member(query.msg.chat.id, challenged_user_id)
+    name = challenge_user_name(challenge)
     keep_anti_flood = msg_contain_anti_flood_advice(query.msg)
-    if query_token[1] == 'correct':
-        text = bot.config['messages'][language]['challenge_passed'].format(
+    templates = bot.templates.get(language)
+    if click.correct:
+        text = templates.render(
+            'challenge_passed',
+            keep_anti_flood,
             user_id=challenged_user_id,
-            name=html_escape(challenged_user.name)
+            name=html_escape(name)
         )
-        if keep_anti_flood:
-            text += '\n' + bot.config['messages'][language]['flood_detected']
         bot.edit_message(
             query.msg.chat.id,
             query.msg.id,
@@ -276,29 +581,24 @@ def challenge_button(query: catbot.CallbackQuery):
             parse_mode='HTML'
         )
         read_record_and_lift(query.msg.chat.id, challenged_user_id)
-        time.sleep(bot.config['shorten_after_pass_delay'])
-        try:
-            text = bot.config['messages'][language]['challenge_passed_short'].format(
-                user_id=challenged_user_id,
-                name=html_escape(challenged_user.name)
-            )
-            if keep_anti_flood:
-                text += '\n' + bot.config['messages'][language]['flood_detected']
-            bot.edit_message(
-                query.msg.chat.id,
-                query.msg.id,
-                text=text,
-                parse_mode='HTML'
-            )
-        except catbot.MessageNotFoundError:
-            pass
+        scheduler.schedule(
+            'shorten',
+            bot.config['shorten_after_pass_delay'],
+            shorten_passed_message,
+            chat_id=query.msg.chat.id,
+            msg_id=query.msg.id,
+            user_id=challenged_user_id,
+            name=name,
+            language=language,
+            keep_anti_flood=keep_anti_flood
+        )
     else:
-        text = bot.config['messages'][language]['challenge_failed'].format(
+        text = templates.render(
+            'challenge_failed',
+            keep_anti_flood,
             user_id=challenged_user_id,
-            name=html_escape(challenged_user.name)
+            name=html_escape(name)
         )
-        if keep_anti_flood:
-            text += '\n' + bot.config['messages'][language]['flood_detected']
         bot.edit_message(
             query.msg.chat.id,
             query.msg.id,
@@ -307,19 +607,48 @@ def challenge_button(query: catbot.CallbackQuery):
         )
 
 
+def stop_timeout(chat_id: int, msg_id: int):
+    """
+    Stop the timer of a challenge claimed from the state backend, if it was started by this process.
+    """
+    timeout = Timeout.find_by_message(chat_id, msg_id)
+    if timeout is not None:
+        timeout.stop()
+
+
+def shorten_passed_message(chat_id: int, msg_id: int, user_id: int, name: str, language: str, keep_anti_flood: bool):
+    try:
+        text = bot.templates.get(language).render(
+            'challenge_passed_short',
+            keep_anti_flood,
+            user_id=user_id,
+            name=html_escape(name)
+        )
+        bot.edit_message(
+            chat_id,
+            msg_id,
+            text=text,
+            parse_mode='HTML',
+            priority=PRIORITY_LOW
+        )
+    except catbot.MessageNotFoundError:
+        pass
+
+
 def kicked_before_captcha_cri(msg: catbot.ChatMemberUpdate):
     return msg.new_chat_member.id != msg.from_.id and msg.new_chat_member.status == 'kicked' and msg.from_.id != bot.id
 
 
 @bot.member_status_task(kicked_before_captcha_cri)
 def kicked_before_captcha(msg: catbot.ChatMemberUpdate):
-    for timeout in Timeout.list_all():
-        if timeout.chat_id == msg.chat.id and timeout.user_id == msg.new_chat_member.id:
-            timeout.stop()
-            try:
-                bot.delete_message(timeout.chat_id, timeout.msg_id)
-            except catbot.DeleteMessageError:
-                pass
+    for challenge in bot.state.find_challenges(msg.chat.id, msg.new_chat_member.id):
+        if bot.state.claim_challenge(challenge.chat_id, challenge.msg_id) is None:
+            continue
+        stop_timeout(challenge.chat_id, challenge.msg_id)
+        try:
+            bot.delete_message(challenge.chat_id, challenge.msg_id)
+        except catbot.DeleteMessageError:
+            pass
 
 
 def manual_operations_cri(query: catbot.CallbackQuery):
@@ -329,8 +658,7 @@ def manual_operations_cri(query: catbot.CallbackQuery):
 @bot.query_task(manual_operations_cri)
 def manual_operations(query: catbot.CallbackQuery):
     language = get_chat_language(query.msg.chat.id)
-    operator = bot.get_chat_member(query.msg.chat.id, query.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(query.msg.chat.id, query.from_.id):
         bot.answer_callback_query(
             query.id,
             text=bot.config['messages'][language]['permission_denied'],
@@ -338,6 +666,7 @@ def manual_operations(query: catbot.CallbackQuery):
             cache_time=bot.config['timeout']
         )
         return
+    operator = bot.get_chat_member(query.msg.chat.id, query.from_.id)
 
     query_token = query.data.split('_')
     if len(query_token) != 2:
@@ -350,10 +679,9 @@ def manual_operations(query: catbot.CallbackQuery):
         return
 
     bot.answer_callback_query(query.id)
-    for timeout in Timeout.list_all():
-        if timeout.chat_id == query.msg.chat.id and timeout.msg_id == query.msg.id:
-            timeout.stop()
-            break
+    # Admins may still act on a challenge that has been resolved
+    bot.state.claim_challenge(query.msg.chat.id, query.msg.id)
+    stop_timeout(query.msg.chat.id, query.msg.id)
 
     challenged_user = bot.get_chat_member(query.msg.chat.id, challenged_user_id)
     if query_token[1] == 'approve':
@@ -393,25 +721,11 @@ def update_restriction_cri(msg: catbot.ChatMemberUpdate):
 
 @bot.member_status_task(update_restriction_cri)
 def update_restriction(msg: catbot.ChatMemberUpdate):
-    with t_lock:
-        if 'restrict_record' in bot.record:
-            restrict_record = bot.record['restrict_record']
-        else:
-            restrict_record = {}
-
-        if msg.new_chat_member.status == 'restricted':
-            until = msg.new_chat_member.until_date
-            if str(msg.chat.id) not in restrict_record:
-                restrict_record[str(msg.chat.id)] = {}
-            restrict_record[str(msg.chat.id)][str(msg.new_chat_member.id)] = {
-                'restricted_by': msg.from_.id,
-                'until': until
-            }
-        else:  # The member is no longer restricted
-            if str(msg.chat.id) in restrict_record:
-                restrict_record[str(msg.chat.id)].pop(str(msg.new_chat_member.id), None)
-
-        bot.record['restrict_record'] = restrict_record
+    bot.invalidate_member(msg)
+    if msg.new_chat_member.status == 'restricted':
+        bot.records.set_restriction(msg.chat.id, msg.new_chat_member.id, msg.from_.id, msg.new_chat_member.until_date)
+    else:  # The member is no longer restricted
+        bot.records.remove_restriction(msg.chat.id, msg.new_chat_member.id)
 
 
 def set_language_cri(msg: catbot.Message) -> bool:
@@ -421,8 +735,7 @@ def set_language_cri(msg: catbot.Message) -> bool:
 @bot.msg_task(set_language_cri)
 def set_language(msg: catbot.Message):
     language = get_chat_language(msg.chat.id)
-    operator = bot.get_chat_member(msg.chat.id, msg.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(msg.chat.id, msg.from_.id):
         bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'])
         return
     button_list = []
@@ -440,8 +753,7 @@ def set_language_button_cri(query: catbot.CallbackQuery) -> bool:
 def set_language_button(query: catbot.CallbackQuery):
     chat_id = query.msg.chat.id
     language = get_chat_language(chat_id)
-    operator = bot.get_chat_member(chat_id, query.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(chat_id, query.from_.id):
         bot.answer_callback_query(
             query.id,
             text=bot.config['messages'][language]['permission_denied'],
@@ -452,13 +764,7 @@ def set_language_button(query: catbot.CallbackQuery):
 
     target_language = query.data.split('_')[1]
     language = target_language
-    with t_lock:
-        if 'language' in bot.record:
-            chat_languages = bot.record['language']
-        else:
-            chat_languages = {}
-        chat_languages[str(chat_id)] = target_language
-        bot.record['language'] = chat_languages
+    bot.records.set_language(chat_id, target_language)
 
     bot.edit_message(query.msg.chat.id, query.msg.id, text=bot.config['messages'][language]['set_language_done'].format(
         language=target_language
@@ -499,14 +805,15 @@ def enable_anti_flood_cri(msg: catbot.Message) -> bool:
 def enable_anti_flood(msg: catbot.Message):
     chat_id = msg.chat.id
     language = get_chat_language(chat_id)
-    operator = bot.get_chat_member(chat_id, msg.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(chat_id, msg.from_.id):
         bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'],
                          reply_to_message_id=msg.reply_to_message.id)
         return
 
     sent = bot.send_message(chat_id, text=bot.config['messages'][language]['anti_flood_enabled'].format(num=0))
-    bot.anti_floods[chat_id].enable(sent)
+    anti: AntiFlood = bot.anti_floods[chat_id]
+    with anti.lock:
+        anti.enable(sent)
 
 
 def disable_anti_flood(msg: catbot.Message) -> bool:
@@ -517,22 +824,37 @@ def disable_anti_flood(msg: catbot.Message) -> bool:
 def disable_anti_flood(msg: catbot.Message):
     chat_id = msg.chat.id
     language = get_chat_language(chat_id)
-    operator = bot.get_chat_member(chat_id, msg.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(chat_id, msg.from_.id):
         bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'],
                          reply_to_message_id=msg.reply_to_message.id)
         return
 
-    if bot.anti_floods[chat_id].enabled:
-        anti: AntiFlood = bot.anti_floods[chat_id]
+    anti: AntiFlood = bot.anti_floods[chat_id]
+    with anti.lock:
+        if not anti.enabled:
+            return
         anti.disable()
-        try:
-            bot.send_message(
-                chat_id,
-                text=bot.config['messages'][language]['anti_flood_disabled'].format(num=anti.counter)
-            )
-        except catbot.APIError as e:
-            logging.info(e.args[0])
+        counter = anti.counter
+    bot.counter_edits.flush(chat_id)
+    announce_anti_flood_disabled(chat_id, language, counter)
+
+
+def record_stats_cri(msg: catbot.Message) -> bool:
+    return bot.detect_command('/record_stats', msg)
+
+
+@bot.msg_task(record_stats_cri)
+def record_stats(msg: catbot.Message):
+    chat_id = msg.chat.id
+    language = get_chat_language(chat_id)
+    if not bot.is_admin(chat_id, msg.from_.id):
+        bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'],
+                         reply_to_message_id=msg.id)
+        return
+
+    bot.send_message(chat_id, text=bot.config['messages'][language]['record_stats'].format(
+        **bot.records.restriction_stats(chat_id)
+    ), reply_to_message_id=msg.id)
 
 
 def add_whitelist_cri(msg: catbot.Message):
@@ -543,8 +865,7 @@ def add_whitelist_cri(msg: catbot.Message):
 def add_whitelist(msg: catbot.Message):
     chat_id = msg.chat.id
     language = get_chat_language(chat_id)
-    operator = bot.get_chat_member(chat_id, msg.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(chat_id, msg.from_.id):
         bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'],
                          reply_to_message_id=msg.id)
         return
@@ -580,8 +901,7 @@ def remove_whitelist_cri(msg: catbot.Message):
 def remove_whitelist(msg: catbot.Message):
     chat_id = msg.chat.id
     language = get_chat_language(chat_id)
-    operator = bot.get_chat_member(chat_id, msg.from_.id)
-    if operator.status != 'administrator' and operator.status != 'creator':
+    if not bot.is_admin(chat_id, msg.from_.id):
         bot.send_message(msg.chat.id, text=bot.config['messages'][language]['permission_denied'],
                          reply_to_message_id=msg.id)
         return
@@ -610,5 +930,18 @@ def remove_whitelist(msg: catbot.Message):
 
 
 if __name__ == '__main__':
+    bot.text_source.start()
     with bot:
-        bot.start()
+        if bot.records.database is not None:
+            bot.records.migrate()
+            scheduler.call_later(bot.config.get('record_compact_interval', 3600), compact_records)
+        bot.records.rebuild_expiry_index()
+        scheduler.call_later(bot.config.get('record_prune_interval', 600), prune_records)
+        logging.info('Recovered pending challenges: {} re-armed, {} expired'.format(*recover_challenges()))
+        if bot.config.get('webhook', {}).get('enable', False):
+            server = WebhookServer.from_config(bot, router=bot.router)
+            if bot.config['webhook'].get('url'):
+                server.set_webhook(bot.config['webhook']['url'])
+            server.serve_forever()
+        else:
+            bot.start()
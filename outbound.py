@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+
+import catbot
+import requests
+
+PRIORITY_HIGH = 0       # restrict and kick, which keep spam out
+PRIORITY_NORMAL = 1     # new messages, verdict edits and deletions
+PRIORITY_LOW = 2        # cosmetic edits, e.g. counters and shortened messages
+
+_TRANSIENT_ERRORS = ('Too Many Requests', 'Internal Server Error', 'Bad Gateway', 'Gateway Timeout')
+
+
+def retry_after(error: catbot.APIError) -> int | None:
+    """
+    Return the delay asked by a "Too Many Requests: retry after N" error, or None for other errors.
+    """
+    match = re.search(r'retry after (\d+)', str(error.args[0]) if error.args else '')
+    return int(match.group(1)) if match else None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self, now: float, reserve: float = 0) -> float:
+        """
+        Take one token if at least `reserve` tokens stay in the bucket afterwards.
+        :param reserve: Capped at capacity - 1, which a full bucket always leaves
+        :return: 0 if the token is taken, otherwise seconds to wait before trying again
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        reserve = min(reserve, self.capacity - 1)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return 0
+        return (reserve + 1 - self.tokens) / self.rate
+
+
+class OutboundLimiter:
+    """
+    Rate limiting for outbound Telegram API calls. New messages take a token from a global bucket, as Telegram's
+    global limit is on messages sent. Every call but restricts, kicks and callback answers also takes a token from
+    the bucket of its chat, where lower priority calls must leave a reserve of tokens behind, so cosmetic edits yield
+    to messages. Flood control errors are retried after the delay Telegram asks for, as the call was refused. Other
+    transient errors are retried with bounded exponential backoff, but a new message only if it surely did not reach
+    Telegram, lest it be sent twice.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 20 / 60, chat_burst: float = 5,
+                 max_retries: int = 3, max_backoff: float = 30, idle: float = 3600):
+        """
+        :param idle: Seconds after which the bucket of a chat without calls is dropped, once it has refilled
+        """
+        if global_rate < 1 or chat_burst < 1 or chat_rate <= 0:
+            raise ValueError('outbound global_rate and chat_burst must be at least 1, chat_rate above 0')
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.idle = idle
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        return bucket
+
+    def try_acquire(self, chat_id: int | None, priority: int, new_message: bool = False) -> float:
+        """
+        Take a token if one is available, without waiting.
+        :param new_message: Take a token from the global bucket as well
+        :return: 0 if the token was taken, otherwise seconds to wait before trying again
+        """
+        global_bucket = self.global_bucket if new_message else None
+        with self._lock:
+            now = time.monotonic()
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and priority > PRIORITY_HIGH else None
+            wait = self._try_take(now, chat_bucket, global_bucket, priority - 1)
+            if now - self._last_sweep > self.idle:
+                self._sweep(now)
+        if wait:
+            self.waited += wait
+        return wait
+
+    def acquire(self, chat_id: int | None, priority: int, new_message: bool = False):
+        """
+        Wait for a token, blocking the calling thread.
+        """
+        while wait := self.try_acquire(chat_id, priority, new_message):
+            time.sleep(wait)
+
+    async def acquire_async(self, chat_id: int | None, priority: int, new_message: bool = False):
+        """
+        Wait for a token on the event loop, so that a coroutine waiting for its turn holds no thread. Pass
+        `acquired=True` to the call() that uses the token.
+        """
+        while wait := self.try_acquire(chat_id, priority, new_message):
+            await asyncio.sleep(wait)
+
+    def _sweep(self, now: float) -> int:
+        """
+        Drop the buckets of chats idle for longer than `idle` seconds. A refilled bucket is no different from a new
+        one, so nothing is lost. Called with the lock held.
+        :return: Number of buckets dropped
+        """
+        self._last_sweep = now
+        idle_chats = [
+            chat_id for chat_id, bucket in self._chat_buckets.items()
+            if bucket.updated < now - self.idle and bucket.blocked_until <= now
+            and bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity
+        ]
+        for chat_id in idle_chats:
+            del self._chat_buckets[chat_id]
+        return len(idle_chats)
+
+    @staticmethod
+    def _try_take(now: float, chat_bucket: TokenBucket | None, global_bucket: TokenBucket | None,
+                  chat_reserve: float) -> float:
+        if chat_bucket is not None:
+            wait = chat_bucket.take(now, chat_reserve)
+            if wait:
+                return wait
+        if global_bucket is None:
+            return 0
+        wait = global_bucket.take(now)
+        if wait and chat_bucket is not None:
+            chat_bucket.tokens += 1     # give the chat token back
+        return wait
+
+    def call(self, chat_id: int | None, priority: int, func, *args, new_message: bool = False, acquired: bool = False,
+             **kwargs):
+        """
+        :param chat_id: Chat whose bucket the call takes a token from, or None for none
+        :param new_message: The call sends a new message, which is not repeated unless it surely did not reach
+            Telegram
+        :param acquired: The token for the first attempt was already taken by acquire_async()
+        """
+        attempt = 0
+        while True:
+            if attempt or not acquired:
+                self.acquire(chat_id, priority, new_message)
+            self.calls += 1
+            try:
+                return func(*args, **kwargs)
+            except catbot.APIError as e:
+                description = str(e.args[0]) if e.args else ''
+                if attempt >= self.max_retries or not any(item in description for item in _TRANSIENT_ERRORS):
+                    raise
+                delay = retry_after(e)
+                if delay is None and new_message:     # the message may have been sent anyway
+                    raise
+                if delay is not None:
+                    self.throttled += 1
+                    if chat_id is not None:     # hold back other calls to the chat as well
+                        with self._lock:
+                            self._chat_bucket(chat_id).blocked_until = time.monotonic() + delay
+                else:
+                    delay = min(self.max_backoff, 2 ** attempt)
+            except requests.RequestException as e:
+                # Only a connect timeout tells the request was never sent
+                if attempt >= self.max_retries or new_message and not isinstance(e, requests.ConnectTimeout):
+                    raise
+                logging.info(f'{func.__name__} failed: {e}')
+                delay = min(self.max_backoff, 2 ** attempt)
+            attempt += 1
+            self.retries += 1
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'waited': self.waited,
+            'chats': len(self._chat_buckets)
+        }
@@ -0,0 +1,250 @@
+import heapq
+import sqlite3
+import threading
+import time
+
+
+class RecordDatabase:
+    """
+    SQLite storage for chat languages and restriction records. Each update is a single-row upsert appended to the
+    write-ahead log, so a crash loses at most the update in flight, and nothing is rewritten as a whole.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS language ('
+                           'chat_id INTEGER PRIMARY KEY, language TEXT NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS restriction ('
+                           'chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, restricted_by INTEGER NOT NULL, '
+                           'until INTEGER NOT NULL, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID')
+
+    def load(self) -> dict[str, dict]:
+        """
+        Read all records into the layout used in bot.record.
+        """
+        languages = {}
+        restrictions: dict[str, dict] = {}
+        with self._lock:
+            for chat_id, language in self._conn.execute('SELECT chat_id, language FROM language'):
+                languages[str(chat_id)] = language
+            for chat_id, user_id, restricted_by, until in self._conn.execute(
+                    'SELECT chat_id, user_id, restricted_by, until FROM restriction'):
+                restrictions.setdefault(str(chat_id), {})[str(user_id)] = {
+                    'restricted_by': restricted_by,
+                    'until': until
+                }
+        return {'language': languages, 'restrict_record': restrictions}
+
+    def set_language(self, chat_id: int, language: str):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO language (chat_id, language) VALUES (?, ?)',
+                               (chat_id, language))
+
+    def set_restriction(self, chat_id: int, user_id: int, restricted_by: int, until: int):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO restriction (chat_id, user_id, restricted_by, until) '
+                               'VALUES (?, ?, ?, ?)', (chat_id, user_id, restricted_by, until or 0))
+
+    def remove_restriction(self, chat_id: int, user_id: int):
+        with self._lock:
+            self._conn.execute('DELETE FROM restriction WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+
+    def get_language(self, chat_id: int) -> str | None:
+        with self._lock:
+            row = self._conn.execute('SELECT language FROM language WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_restriction(self, chat_id: int, user_id: int) -> dict | None:
+        with self._lock:
+            row = self._conn.execute('SELECT restricted_by, until FROM restriction WHERE chat_id = ? AND user_id = ?',
+                                     (chat_id, user_id)).fetchone()
+        if row is None:
+            return None
+        return {'restricted_by': row[0], 'until': row[1]}
+
+    def import_record(self, record: dict):
+        """
+        Import the language and restrict_record sections of a JSON record in one transaction.
+        """
+        languages = [(int(chat_id), language) for chat_id, language in record.get('language', {}).items()]
+        restrictions = [
+            (int(chat_id), int(user_id), item['restricted_by'], item['until'] or 0)
+            for chat_id, users in record.get('restrict_record', {}).items()
+            for user_id, item in users.items()
+        ]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO language (chat_id, language) VALUES (?, ?)', languages)
+            self._conn.executemany('INSERT OR REPLACE INTO restriction (chat_id, user_id, restricted_by, until) '
+                                   'VALUES (?, ?, ?, ?)', restrictions)
+            self._conn.execute('COMMIT')
+
+    def compact(self):
+        """
+        Fold the write-ahead log back into the database file and release free pages.
+        """
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._conn.execute('PRAGMA incremental_vacuum')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RecordStore:
+    """
+    Chat languages and restriction records. Writes take one of `shards` locks chosen by chat id, so restriction churn
+    in one busy group does not hold up any other group. Reads take no lock. The dict of a chat is modified in place,
+    but only by single item assignments and pops, and reads only look items up, which are each atomic in CPython, so a
+    read sees a record either before or after a write, never half of it.
+
+    Without a database, records live in bot.record and are saved with it. With a database, they are loaded from it
+    once and every write goes through to it. When several bot processes share the database, `read_through` makes
+    reads of single records go to the database too, so writes by the other processes are seen.
+    """
+
+    def __init__(self, record_getter, shards: int = 64, database: RecordDatabase | None = None,
+                 read_through: bool = False):
+        """
+        :param record_getter: Callable returning the record dict. The dict may be replaced when it is (re)loaded.
+        """
+        self._record = record_getter
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.database = database
+        self.read_through = read_through and database is not None
+        self._sections = database.load() if database is not None else None
+        # (until, chat_id, user_id) of restrictions with an end date. Entries outdated by a later update stay in the
+        # heap and are skipped when they come out.
+        self._expiry: list[tuple[int, int, int]] = []
+        self._expiry_lock = threading.Lock()
+        self._pruned: dict[int, int] = {}     # restrictions pruned since start, by chat
+
+    def _section(self, name: str) -> dict:
+        if self._sections is not None:
+            return self._sections[name]
+        record = self._record()
+        section = record.get(name)
+        if section is None:
+            section = record.setdefault(name, {})
+        return section
+
+    def _lock(self, chat_id: int) -> threading.Lock:
+        return self._locks[hash(chat_id) % len(self._locks)]
+
+    def migrate(self):
+        """
+        Move records left in bot.record by earlier versions into the database.
+        """
+        if self.database is None:
+            return
+        record = self._record()
+        if 'language' not in record and 'restrict_record' not in record:
+            return
+        self.database.import_record(record)
+        record.pop('language', None)
+        record.pop('restrict_record', None)
+        self._sections = self.database.load()
+
+    def get_language(self, chat_id: int, default: str = 'en') -> str:
+        if self.read_through:
+            language = self.database.get_language(chat_id)
+            return language if language is not None else default
+        return self._section('language').get(str(chat_id), default)
+
+    def set_language(self, chat_id: int, language: str):
+        with self._lock(chat_id):
+            self._section('language')[str(chat_id)] = language
+            if self.database is not None:
+                self.database.set_language(chat_id, language)
+
+    def get_restriction(self, chat_id: int, user_id: int) -> dict | None:
+        if self.read_through:
+            return self.database.get_restriction(chat_id, user_id)
+        chat_record = self._section('restrict_record').get(str(chat_id))
+        if chat_record is None:
+            return None
+        return chat_record.get(str(user_id))
+
+    def set_restriction(self, chat_id: int, user_id: int, restricted_by: int, until: int):
+        with self._lock(chat_id):
+            chat_record = self._section('restrict_record').setdefault(str(chat_id), {})
+            chat_record[str(user_id)] = {
+                'restricted_by': restricted_by,
+                'until': until
+            }
+            if self.database is not None:
+                self.database.set_restriction(chat_id, user_id, restricted_by, until)
+        if until:
+            with self._expiry_lock:
+                heapq.heappush(self._expiry, (until, chat_id, user_id))
+
+    def remove_restriction(self, chat_id: int, user_id: int):
+        with self._lock(chat_id):
+            chat_record = self._section('restrict_record').get(str(chat_id))
+            if chat_record is not None:
+                chat_record.pop(str(user_id), None)
+            if self.database is not None:
+                self.database.remove_restriction(chat_id, user_id)
+
+    def rebuild_expiry_index(self) -> int:
+        """
+        Index the end dates of all loaded restrictions, then prune the expired ones.
+        :return: Number of restrictions pruned
+        """
+        expiry = [
+            (item['until'], int(chat_id), int(user_id))
+            for chat_id, users in list(self._section('restrict_record').items())
+            for user_id, item in list(users.items())
+            if item['until']
+        ]
+        heapq.heapify(expiry)
+        with self._expiry_lock:
+            self._expiry = expiry
+        return self.prune()
+
+    def prune(self, now: float | None = None) -> int:
+        """
+        Remove restrictions that ended before `now`. Restrictions without an end date are kept.
+        :return: Number of restrictions pruned
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        with self._expiry_lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expired.append(heapq.heappop(self._expiry))
+
+        count = 0
+        for until, chat_id, user_id in expired:
+            with self._lock(chat_id):
+                chat_record = self._section('restrict_record').get(str(chat_id))
+                item = chat_record.get(str(user_id)) if chat_record is not None else None
+                if item is None or item['until'] != until:     # removed or updated since
+                    continue
+                del chat_record[str(user_id)]
+                if not chat_record:
+                    self._section('restrict_record').pop(str(chat_id), None)
+                if self.database is not None:
+                    self.database.remove_restriction(chat_id, user_id)
+                self._pruned[chat_id] = self._pruned.get(chat_id, 0) + 1
+            count += 1
+        return count
+
+    def restriction_stats(self, chat_id: int, now: float | None = None) -> dict:
+        """
+        Statistics of one chat only, as they are shown to its admins. Restrictions that ended but are not pruned yet
+        are not counted as live.
+        """
+        if now is None:
+            now = time.time()
+        users = list(self._section('restrict_record').get(str(chat_id), {}).values())
+        return {
+            'live': sum(1 for item in users if not item['until'] or item['until'] > now),
+            'pruned': self._pruned.get(chat_id, 0)
+        }
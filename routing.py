@@ -0,0 +1,79 @@
+import json
+import logging
+import urllib.error
+import urllib.request
+
+
+def update_chat_id(update: dict) -> int | None:
+    """
+    Return the id of the chat an update belongs to, or None if it belongs to no chat.
+    """
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update and 'message' in update['callback_query']:
+        return update['callback_query']['message']['chat']['id']
+    if 'chat_member' in update:
+        return update['chat_member']['chat']['id']
+    return None
+
+
+class ChatRouter:
+    """
+    Split chats among `count` bot processes by chat id. In webhook mode, a process receiving an update of a chat it
+    does not own forwards the update to the webhook of the owner, so every chat is handled by one process and its
+    per-process state, such as anti-flood, stays consistent.
+    """
+
+    def __init__(self, index: int = 0, count: int = 1, peers: list[str] | None = None, secret_token: str = '',
+                 timeout: float = 5):
+        """
+        :param peers: Webhook URLs of all processes, indexed like `index`
+        """
+        self.index = index
+        self.count = count
+        self.peers = peers or []
+        self.secret_token = secret_token
+        self.timeout = timeout
+
+        self.forwarded = 0
+        self.forward_failed = 0
+
+    @classmethod
+    def from_config(cls, bot) -> 'ChatRouter':
+        config = bot.config.get('sharding', {})
+        return cls(
+            index=int(config.get('index', 0)),
+            count=int(config.get('count', 1)),
+            peers=config.get('peers', []),
+            secret_token=bot.config.get('webhook', {}).get('secret_token', '')
+        )
+
+    def owner(self, chat_id: int) -> int:
+        return chat_id % self.count
+
+    def owns(self, chat_id: int | None) -> bool:
+        return chat_id is None or self.count <= 1 or self.owner(chat_id) == self.index
+
+    def forward(self, update: dict, chat_id: int) -> bool:
+        """
+        POST an update to the webhook of the process owning its chat.
+        :return: Whether the owner accepted the update
+        """
+        owner = self.owner(chat_id)
+        if owner >= len(self.peers):
+            logging.warning(f'No webhook URL for worker {owner}, handling chat {chat_id} locally')
+            return False
+        request = urllib.request.Request(
+            self.peers[owner],
+            data=json.dumps(update).encode(),
+            headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': self.secret_token}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (urllib.error.URLError, OSError) as e:
+            self.forward_failed += 1
+            logging.warning(f'Failed to forward update {update.get("update_id")} to worker {owner}: {e}')
+            return False
+        self.forwarded += 1
+        return True
@@ -0,0 +1,218 @@
+from abc import ABC, abstractmethod
+import contextlib
+import sqlite3
+import threading
+
+from anti_flood import FloodDetector
+
+
+class ChallengeRecord:
+    def __init__(self, chat_id: int, msg_id: int, user_id: int, deadline: float, is_flooding: bool = False,
+                 answer: str = '', name: str = ''):
+        """
+        :param deadline: Unix time at which the challenge fails
+        :param answer: The correct choice
+        :param name: Name of the user when they joined
+        """
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+        self.user_id = user_id
+        self.deadline = deadline
+        self.is_flooding = is_flooding
+        self.answer = answer
+        self.name = name
+
+
+class StateBackend(ABC):
+    """
+    Runtime state that must be shared by all bot processes: pending challenges and join flood windows.
+
+    A pending challenge is resolved by exactly one party, whoever claims it first: the process whose timer expires,
+    or any process receiving a click or a member update for it.
+    """
+
+    @abstractmethod
+    def add_challenge(self, record: ChallengeRecord):
+        pass
+
+    @abstractmethod
+    def claim_challenge(self, chat_id: int, msg_id: int) -> ChallengeRecord | None:
+        """
+        Atomically remove a pending challenge.
+        :return: The challenge, or None if it is unknown or was claimed already
+        """
+        pass
+
+    @abstractmethod
+    def find_challenges(self, chat_id: int, user_id: int) -> list[ChallengeRecord]:
+        pass
+
+    @abstractmethod
+    def list_challenges(self, chat_id: int | None = None) -> list[ChallengeRecord]:
+        pass
+
+    @abstractmethod
+    def flood_hit(self, chat_id: int, timestamp: float) -> int:
+        """
+        Record a join and return the number of joins within the flood period, including this one.
+        """
+        pass
+
+    @abstractmethod
+    def flood_recent(self, chat_id: int, now: float) -> int:
+        """
+        Return the number of joins within the flood period without recording one.
+        """
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    State kept in this process, for a single bot process. Pending challenges are lost on restart.
+    """
+
+    def __init__(self, flood_period: int, flood_count: int):
+        self.flood_detector = FloodDetector(flood_period, flood_count)
+        self._challenges: dict[tuple[int, int], ChallengeRecord] = {}
+        self._by_user: dict[tuple[int, int], set[int]] = {}
+        self._lock = threading.Lock()
+
+    def add_challenge(self, record: ChallengeRecord):
+        with self._lock:
+            self._challenges[(record.chat_id, record.msg_id)] = record
+            self._by_user.setdefault((record.chat_id, record.user_id), set()).add(record.msg_id)
+
+    def claim_challenge(self, chat_id: int, msg_id: int) -> ChallengeRecord | None:
+        with self._lock:
+            record = self._challenges.pop((chat_id, msg_id), None)
+            if record is not None:
+                msg_ids = self._by_user[(chat_id, record.user_id)]
+                msg_ids.discard(msg_id)
+                if not msg_ids:
+                    del self._by_user[(chat_id, record.user_id)]
+            return record
+
+    def find_challenges(self, chat_id: int, user_id: int) -> list[ChallengeRecord]:
+        with self._lock:
+            return [self._challenges[(chat_id, msg_id)] for msg_id in self._by_user.get((chat_id, user_id), ())]
+
+    def list_challenges(self, chat_id: int | None = None) -> list[ChallengeRecord]:
+        with self._lock:
+            return [record for record in self._challenges.values() if chat_id is None or record.chat_id == chat_id]
+
+    def flood_hit(self, chat_id: int, timestamp: float) -> int:
+        return self.flood_detector.hit(chat_id, timestamp)
+
+    def flood_recent(self, chat_id: int, now: float) -> int:
+        return self.flood_detector.recent(chat_id, now)
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    State in a SQLite database shared by the bot processes of one host. SQLite serialises writers across processes,
+    which makes claiming a challenge atomic. Pending challenges survive a restart, see list_challenges().
+    """
+
+    def __init__(self, path: str, flood_period: int, flood_count: int, idle: int = 3600):
+        self.path = path
+        self.flood_period = flood_period
+        self.flood_count = flood_count
+        self.idle = idle
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS challenge ('
+                           'chat_id INTEGER NOT NULL, msg_id INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+                           'deadline REAL NOT NULL, is_flooding INTEGER NOT NULL, '
+                           "answer TEXT NOT NULL DEFAULT '', name TEXT NOT NULL DEFAULT '', "
+                           'PRIMARY KEY (chat_id, msg_id)) WITHOUT ROWID')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(challenge)')]
+        for column in ('answer', 'name'):
+            if column not in columns:     # created by an earlier version
+                self._conn.execute(f"ALTER TABLE challenge ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS challenge_user ON challenge (chat_id, user_id)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS flood (chat_id INTEGER NOT NULL, timestamp REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS flood_chat ON flood (chat_id, timestamp)')
+
+    _CHALLENGE_COLUMNS = 'chat_id, msg_id, user_id, deadline, is_flooding, answer, name'
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    @staticmethod
+    def _challenge(row: tuple) -> ChallengeRecord:
+        chat_id, msg_id, user_id, deadline, is_flooding, answer, name = row
+        return ChallengeRecord(chat_id, msg_id, user_id, deadline, bool(is_flooding), answer, name)
+
+    def add_challenge(self, record: ChallengeRecord):
+        with self._lock:
+            self._conn.execute(f'INSERT OR REPLACE INTO challenge ({self._CHALLENGE_COLUMNS}) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (record.chat_id, record.msg_id, record.user_id, record.deadline,
+                                int(record.is_flooding), record.answer, record.name))
+
+    def claim_challenge(self, chat_id: int, msg_id: int) -> ChallengeRecord | None:
+        with self._lock:
+            with self._transaction():
+                row = self._conn.execute(f'SELECT {self._CHALLENGE_COLUMNS} FROM challenge '
+                                         'WHERE chat_id = ? AND msg_id = ?', (chat_id, msg_id)).fetchone()
+                if row is not None:
+                    self._conn.execute('DELETE FROM challenge WHERE chat_id = ? AND msg_id = ?', (chat_id, msg_id))
+        return self._challenge(row) if row is not None else None
+
+    def find_challenges(self, chat_id: int, user_id: int) -> list[ChallengeRecord]:
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {self._CHALLENGE_COLUMNS} FROM challenge '
+                                      'WHERE chat_id = ? AND user_id = ?', (chat_id, user_id)).fetchall()
+        return [self._challenge(row) for row in rows]
+
+    def list_challenges(self, chat_id: int | None = None) -> list[ChallengeRecord]:
+        with self._lock:
+            if chat_id is None:
+                rows = self._conn.execute(f'SELECT {self._CHALLENGE_COLUMNS} FROM challenge').fetchall()
+            else:
+                rows = self._conn.execute(f'SELECT {self._CHALLENGE_COLUMNS} FROM challenge WHERE chat_id = ?',
+                                          (chat_id,)).fetchall()
+        return [self._challenge(row) for row in rows]
+
+    def flood_hit(self, chat_id: int, timestamp: float) -> int:
+        with self._lock:
+            with self._transaction():
+                self._conn.execute('DELETE FROM flood WHERE chat_id = ? AND timestamp < ?',
+                                   (chat_id, timestamp - self.flood_period))
+                self._conn.execute('INSERT INTO flood (chat_id, timestamp) VALUES (?, ?)', (chat_id, timestamp))
+                count = self._conn.execute('SELECT COUNT(*) FROM flood WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+        if timestamp - self._last_sweep > self.idle:
+            self.sweep(timestamp)
+        return count
+
+    def flood_recent(self, chat_id: int, now: float) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM flood WHERE chat_id = ? AND timestamp >= ?',
+                                      (chat_id, now - self.flood_period)).fetchone()[0]
+
+    def sweep(self, now: float):
+        """
+        Drop join timestamps of chats that have been idle, which flood_hit() never visits again.
+        """
+        self._last_sweep = now
+        with self._lock:
+            self._conn.execute('DELETE FROM flood WHERE timestamp < ?', (now - self.flood_period,))
+
+
+def create_backend(config: dict, flood_period: int, flood_count: int) -> StateBackend:
+    """
+    :param config: The "state" section of the bot config
+    """
+    if config.get('backend', 'memory') == 'sqlite':
+        return SQLiteStateBackend(config.get('path', 'state.sqlite3'), flood_period, flood_count)
+    return MemoryStateBackend(flood_period, flood_count)
@@ -0,0 +1,72 @@
+import threading
+
+import catbot
+
+# Separator between a message and the flood warning appended to it
+FLOOD_SEPARATORS = {
+    'new_member': '\n\n'
+}
+
+
+class LanguageTemplates:
+    """
+    The messages of one language, with the flood warning already appended to the variants that may carry it, and
+    the buttons that are the same for every challenge.
+    """
+
+    def __init__(self, language: str, messages: dict):
+        self.language = language
+        self.messages = messages
+        flood = messages.get('flood_detected', '')
+        self._flooded = {
+            key: text + FLOOD_SEPARATORS.get(key, '\n') + flood
+            for key, text in messages.items()
+            if isinstance(text, str)
+        }
+        self._approve_text = messages.get('manually_approve', '')
+        self._reject_text = messages.get('manually_reject', '')
+
+    def render(self, key: str, flooding: bool = False, **kwargs) -> str:
+        """
+        :param flooding: Append the flood warning
+        """
+        return (self._flooded if flooding else self.messages)[key].format_map(kwargs)
+
+    def challenge_keyboard(self, user_id: int, choices: list[str], callback_data: list[str]) -> catbot.InlineKeyboard:
+        """
+        :param callback_data: Callback data of each choice
+        """
+        return catbot.InlineKeyboard([
+            [catbot.InlineKeyboardButton(text=text, callback_data=data) for text, data in zip(choices, callback_data)],
+            [
+                catbot.InlineKeyboardButton(text=self._approve_text, callback_data=f'{user_id}_approve'),
+                catbot.InlineKeyboardButton(text=self._reject_text, callback_data=f'{user_id}_reject')
+            ]
+        ])
+
+
+class TemplateCache:
+    """
+    LanguageTemplates of every language in the config, built once and rebuilt when the messages are replaced, e.g.
+    when the config is reloaded.
+    """
+
+    def __init__(self, config_getter):
+        """
+        :param config_getter: Callable returning the bot config
+        """
+        self._config = config_getter
+        self._messages: dict | None = None
+        self._templates: dict[str, LanguageTemplates] = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        with self._lock:
+            messages = self._config()['messages']
+            self._templates = {language: LanguageTemplates(language, items) for language, items in messages.items()}
+            self._messages = messages
+
+    def get(self, language: str) -> LanguageTemplates:
+        if self._config()['messages'] is not self._messages:
+            self.rebuild()
+        return self._templates[language]
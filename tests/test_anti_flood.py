@@ -0,0 +1,34 @@
+from anti_flood import FloodDetector
+
+
+def test_hit_and_sweep():
+    detector = FloodDetector(period=10, count=3, idle=100)
+    assert detector.hit(1, 1000) == 1
+    assert detector.hit(1, 1005) == 2
+    assert not detector.is_flooding(2, 1005)
+    assert detector.is_flooding(1, 1009)
+    assert detector.recent(1, 1012) == 2
+
+    # Only the chat without joins since 1007 is dropped
+    assert detector.sweep(1107) == 1
+    assert len(detector) == 1
+    assert detector.recent(2, 1107) == 0
+    assert detector.hit(1, 1108) == 1
+
+
+def test_sweep_between_lookup_and_append():
+    detector = FloodDetector(period=10, count=3, idle=100)
+    detector.hit(1, 1000)
+    lookup = detector._window
+    swept = []
+
+    def window_then_sweep(chat_id: int):
+        window = lookup(chat_id)
+        if not swept:     # the window is idle as of 2000 and dropped before the join is appended
+            swept.append(detector.sweep(2000))
+        return window
+
+    detector._window = window_then_sweep
+    assert detector.hit(1, 2001) == 1
+    assert swept == [1]
+    assert detector.recent(1, 2001) == 1
@@ -0,0 +1,77 @@
+from callback_data import CallbackSigner, CHALLENGE_PREFIX
+
+CHAT_ID = -1001234567890
+USER_ID = 123456789
+EXPIRY = 2000000000
+CHOICES = ['甲', '乙', '丙', '丁', '戊', '己']
+ANSWER = '丙'
+
+
+def sign(signer: CallbackSigner, user_id: int = USER_ID) -> list[str]:
+    return signer.sign_choices(CHAT_ID, signer.new_challenge_id(), user_id, EXPIRY, CHOICES, ANSWER)
+
+
+def test_round_trip():
+    signer = CallbackSigner(b'key')
+    data = sign(signer)
+    clicks = [signer.verify(CHAT_ID, item, now=EXPIRY - 1) for item in data]
+    assert [click.choice for click in clicks] == list(range(len(CHOICES)))
+    assert [click.correct for click in clicks] == [choice == ANSWER for choice in CHOICES]
+    assert all(click.user_id == USER_ID and click.expiry == EXPIRY and not click.expired for click in clicks)
+    assert len({click.challenge_id for click in clicks}) == 1
+    # sign() gives the same data as sign_choices()
+    challenge_id = clicks[0].challenge_id
+    assert signer.sign(CHAT_ID, challenge_id, USER_ID, 2, EXPIRY, True) == data[2]
+    assert signer.stats() == {'forged': 0, 'expired': 0}
+
+
+def test_other_chat_or_key():
+    signer = CallbackSigner(b'key')
+    data = sign(signer)[0]
+    assert signer.verify(CHAT_ID + 1, data, now=0) is None
+    assert CallbackSigner(b'other key').verify(CHAT_ID, data, now=0) is None
+    assert signer.stats()['forged'] == 1
+
+
+def test_tampered():
+    signer = CallbackSigner(b'key')
+    data = sign(signer)
+    payload, tag = data[0].rsplit(':', 1)
+    challenge_id, user_id, choice, expiry = payload[len(CHALLENGE_PREFIX):].split(':')
+
+    # Another choice under the tag of the first one
+    assert signer.verify(CHAT_ID, f'{CHALLENGE_PREFIX}{challenge_id}:{user_id}:2:{expiry}:{tag}', now=0) is None
+    # Another user, or a later expiry
+    assert signer.verify(CHAT_ID, f'{CHALLENGE_PREFIX}{challenge_id}:{USER_ID + 1}:{choice}:{expiry}:{tag}',
+                         now=0) is None
+    assert signer.verify(CHAT_ID, f'{CHALLENGE_PREFIX}{challenge_id}:{user_id}:{choice}:zzzzzz:{tag}', now=0) is None
+    # A tag of the wrong length, no prefix, no tag at all
+    assert signer.verify(CHAT_ID, data[0][:-1], now=0) is None
+    assert signer.verify(CHAT_ID, data[0][len(CHALLENGE_PREFIX):], now=0) is None
+    assert signer.verify(CHAT_ID, payload, now=0) is None
+    assert signer.stats()['forged'] == 6
+
+
+def test_expired():
+    signer = CallbackSigner(b'key')
+    data = sign(signer)[2]
+    assert not signer.verify(CHAT_ID, data, now=EXPIRY).expired
+    click = signer.verify(CHAT_ID, data, now=EXPIRY + 1)
+    assert click.expired and click.correct
+    assert signer.stats() == {'forged': 0, 'expired': 1}
+
+
+def test_size_limit():
+    # Telegram refuses callback data over 64 bytes
+    signer = CallbackSigner(b'key')
+    for data in sign(signer, user_id=9999999999999):
+        assert len(data.encode()) <= 64
+        assert signer.verify(CHAT_ID, data, now=0).user_id == 9999999999999
+
+
+def test_from_config():
+    config = {'token': '123:abc', 'callback_secret': ''}
+    data = sign(CallbackSigner.from_config(config))[0]
+    assert CallbackSigner.from_config(config).verify(CHAT_ID, data, now=0) is not None
+    assert CallbackSigner.from_config({'token': '123:abd'}).verify(CHAT_ID, data, now=0) is None
+    assert CallbackSigner.from_config({**config, 'callback_secret': 'secret'}).verify(CHAT_ID, data, now=0) is None
@@ -0,0 +1,93 @@
+import array
+import os
+import shutil
+
+import pytest
+
+from corpus import PASSAGE_LENGTH, build_index, TextCorpus
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'corpus.txt')
+
+# Usable passages of the fixture, whitespace removed. The last line of 58 han characters is cut after
+# PASSAGE_LENGTH, and its tail of 8 is too short to be used.
+PASSAGES = [
+    '天地玄黃，宇宙洪荒。日月盈昃，辰宿列張。',
+    'Chapter1:寒來暑往，秋收冬藏。閏餘成歲，律呂調陽。',
+    '天地玄黃宇宙洪荒日月盈昃辰宿列張寒來暑往秋收冬藏閏餘成歲律呂調陽雲騰致雨露結為霜金生麗水玉出崑岡劍號'
+]
+
+
+def read_index(index_path: str) -> list[tuple[int, int]]:
+    index = array.array('Q')
+    with open(index_path, 'rb') as f:
+        index.frombytes(f.read())
+    return list(zip(index[::2], index[1::2]))
+
+
+@pytest.fixture
+def corpus_path(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    shutil.copyfile(FIXTURE, path)
+    return str(path)
+
+
+def test_build_index_byte_offsets(corpus_path, tmp_path):
+    index_path = str(tmp_path / 'corpus.idx')
+    assert build_index(corpus_path, index_path) == len(PASSAGES)
+
+    with open(corpus_path, 'rb') as f:
+        data = f.read()
+    entries = read_index(index_path)
+    # The offsets count bytes, which differ from characters before each passage
+    assert [entry[0] for entry in entries] == [
+        data.index('天地玄黃，'.encode('utf-8')),
+        data.index(b'Chapter 1'),
+        data.index('天地玄黃宇'.encode('utf-8'))
+    ]
+    texts = [''.join(data[offset:offset + length].decode('utf-8').split()) for offset, length in entries]
+    assert texts == PASSAGES
+    assert len(texts[2]) == PASSAGE_LENGTH
+
+
+def test_get(corpus_path, tmp_path):
+    corpus = TextCorpus(corpus_path, str(tmp_path / 'corpus.idx'))
+    texts = {corpus.get() for _ in range(100)}
+    assert texts <= set(PASSAGES)
+    assert len(corpus) == len(PASSAGES)
+    assert corpus.stats() == {'passages': len(PASSAGES), 'served': 100}
+
+
+def test_default_index_path(corpus_path):
+    corpus = TextCorpus(corpus_path)
+    corpus.start()
+    assert os.path.exists(corpus_path + '.idx')
+    assert corpus.get() in PASSAGES
+
+
+def test_no_usable_passage(tmp_path):
+    corpus_path = tmp_path / 'corpus.txt'
+    corpus_path.write_text('Plain ASCII line.\n\n短句。\n', encoding='utf-8')
+    corpus = TextCorpus(str(corpus_path))
+    with pytest.raises(ValueError):
+        corpus.start()
+    assert build_index(str(corpus_path), str(tmp_path / 'other.idx')) == 0
+
+
+def test_stale_index_rebuilt(corpus_path, tmp_path):
+    index_path = str(tmp_path / 'corpus.idx')
+    build_index(corpus_path, index_path)
+    with open(corpus_path, 'a', encoding='utf-8') as f:
+        f.write('雲騰致雨，露結為霜。金生麗水，玉出崑岡。\n')
+
+    # An index newer than the corpus is used as it is
+    os.utime(corpus_path, (1000, 1000))
+    os.utime(index_path, (2000, 2000))
+    corpus = TextCorpus(corpus_path, index_path)
+    corpus.start()
+    assert len(corpus) == len(PASSAGES)
+
+    os.utime(corpus_path, (3000, 3000))
+    corpus = TextCorpus(corpus_path, index_path)
+    corpus.start()
+    assert len(corpus) == len(PASSAGES) + 1
+    assert os.path.getmtime(index_path) > 3000
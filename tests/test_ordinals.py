@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+import challenge
+from challenge import TextReadingChallenge
+
+
+class FakeHumanize:
+    """
+    Stands in for humanize's process-wide locale, and takes its time to render an ordinal so that a locale switched
+    by another thread shows up in the result.
+    """
+
+    def __init__(self):
+        self.locale = None
+
+    def activate(self, language: str):
+        self.locale = language
+
+    def deactivate(self):
+        self.locale = None
+
+    def ordinal(self, number: int) -> str:
+        locale = self.locale
+        time.sleep(0.0005)
+        return f'{number}.{locale}' if self.locale == locale else 'mixed'
+
+
+@pytest.fixture
+def humanize(monkeypatch):
+    fake = FakeHumanize()
+    monkeypatch.setattr(challenge.humanize, 'activate', fake.activate)
+    monkeypatch.setattr(challenge.humanize, 'deactivate', fake.deactivate)
+    monkeypatch.setattr(challenge.humanize, 'ordinal', fake.ordinal)
+    monkeypatch.setattr(TextReadingChallenge, '_ordinals', {})
+    return fake
+
+
+def expected(number: int, language: str) -> str:
+    if language.startswith('zh'):
+        return str(number)
+    return f'{number}.{None if language == "en" else language}'
+
+
+def test_ordinal_per_language(humanize):
+    TextReadingChallenge.prepare_ordinals(['en', 'fr'])
+    assert TextReadingChallenge.ordinal(3, 'en') == '3.None'
+    assert TextReadingChallenge.ordinal(3, 'fr') == '3.fr'
+    assert TextReadingChallenge.ordinal(3, 'zh-cn') == '3'
+    # Out of the table, rendered on demand
+    assert TextReadingChallenge.ordinal(12, 'fr') == '12.fr'
+    assert humanize.locale is None
+
+
+def test_ordinal_from_threads(humanize):
+    languages = ['en', 'fr', 'de', 'ja', 'zh-cn', 'zh-tw']
+    errors = []
+    barrier = threading.Barrier(len(languages) * 2)
+
+    def render(language: str):
+        barrier.wait()
+        for _ in range(5):
+            for number in range(1, 14):
+                result = TextReadingChallenge.ordinal(number, language)
+                if result != expected(number, language):
+                    errors.append((language, number, result))
+
+    threads = [threading.Thread(target=render, args=(language,)) for language in languages * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert set(TextReadingChallenge._ordinals) == set(languages)
+    assert humanize.locale is None
@@ -0,0 +1,89 @@
+import threading
+from collections import Counter
+
+import pytest
+
+from state import ChallengeRecord, MemoryStateBackend, SQLiteStateBackend, create_backend
+
+PERIOD = 10
+COUNT = 3
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backends(request, tmp_path) -> list:
+    """
+    Two views of one state, as two bot processes would have. The memory backend is shared by a single process only.
+    """
+    if request.param == 'memory':
+        backend = MemoryStateBackend(PERIOD, COUNT)
+        return [backend, backend]
+    path = str(tmp_path / 'state.sqlite3')
+    return [SQLiteStateBackend(path, PERIOD, COUNT), SQLiteStateBackend(path, PERIOD, COUNT)]
+
+
+def test_challenge_round_trip(backends):
+    first, second = backends
+    first.add_challenge(ChallengeRecord(-100, 1, 10, 1000.5, True, '丙', 'Alice'))
+    first.add_challenge(ChallengeRecord(-100, 2, 10, 2000, False, '甲', 'Alice'))
+    first.add_challenge(ChallengeRecord(-200, 1, 20, 3000))
+
+    assert sorted(record.msg_id for record in second.find_challenges(-100, 10)) == [1, 2]
+    assert second.find_challenges(-100, 20) == []
+    assert len(second.list_challenges()) == 3
+    assert [record.user_id for record in second.list_challenges(-200)] == [20]
+
+    record = second.claim_challenge(-100, 1)
+    assert (record.chat_id, record.msg_id, record.user_id, record.deadline, record.is_flooding, record.answer,
+            record.name) == (-100, 1, 10, 1000.5, True, '丙', 'Alice')
+    assert first.claim_challenge(-100, 1) is None
+    assert [record.msg_id for record in first.find_challenges(-100, 10)] == [2]
+    assert second.claim_challenge(-300, 1) is None
+
+
+def test_claim_once_concurrently(backends):
+    challenges = [(-100 - i % 5, i) for i in range(200)]
+    for chat_id, msg_id in challenges:
+        backends[0].add_challenge(ChallengeRecord(chat_id, msg_id, msg_id, 1000))
+
+    wins = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(8)
+
+    def claim(backend):
+        barrier.wait()
+        for chat_id, msg_id in challenges:
+            if backend.claim_challenge(chat_id, msg_id) is not None:
+                with lock:
+                    wins[(chat_id, msg_id)] += 1
+
+    threads = [threading.Thread(target=claim, args=(backends[i % 2],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert wins == Counter(dict.fromkeys(challenges, 1))
+    assert backends[0].list_challenges() == []
+    assert backends[1].list_challenges() == []
+
+
+def test_flood_window(backends):
+    first, second = backends
+    assert first.flood_hit(-100, 1000) == 1
+    assert second.flood_hit(-100, 1001) == 2
+    assert first.flood_hit(-200, 1002) == 1
+    assert first.flood_hit(-100, 1005) == 3
+    assert second.flood_recent(-100, 1005) == 3
+    assert second.flood_recent(-300, 1005) == 0
+
+    # Joins older than the period drop out of the window
+    assert second.flood_recent(-100, 1010.5) == 2
+    assert first.flood_hit(-100, 1011.5) == 2
+    assert first.flood_recent(-100, 1100) == 0
+    assert second.flood_hit(-200, 1100) == 1
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend({}, PERIOD, COUNT), MemoryStateBackend)
+    backend = create_backend({'backend': 'sqlite', 'path': str(tmp_path / 'state.sqlite3')}, PERIOD, COUNT)
+    assert isinstance(backend, SQLiteStateBackend)
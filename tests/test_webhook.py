@@ -0,0 +1,122 @@
+import http.client
+import json
+import threading
+from collections import defaultdict
+
+import pytest
+
+from webhook import MAX_BODY_SIZE, WebhookServer
+
+TOKEN = 'secret'
+
+
+def message_update(update_id: int, text: str = 'hello') -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': -1001234567890, 'type': 'supergroup', 'title': 'Group'},
+            'from': {'id': 123456789, 'is_bot': False, 'first_name': 'Alice'},
+            'text': text
+        }
+    }
+
+
+class FakeBot:
+    def __init__(self):
+        self.handlers = defaultdict(list)
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def make_server(bot):
+    servers = []
+
+    def make(**kwargs) -> WebhookServer:
+        server = WebhookServer(bot, port=0, path='/hook', secret_token=TOKEN, **kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+
+
+def post(server: WebhookServer, body: bytes, token: str | None = TOKEN, path: str = '/hook',
+         length: int | None = None) -> int:
+    connection = http.client.HTTPConnection(*server.address, timeout=5)
+    try:
+        connection.putrequest('POST', path)
+        connection.putheader('Content-Type', 'application/json')
+        connection.putheader('Content-Length', str(len(body) if length is None else length))
+        if token is not None:
+            connection.putheader('X-Telegram-Bot-Api-Secret-Token', token)
+        connection.endheaders(body)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def post_update(server: WebhookServer, update: dict, **kwargs) -> int:
+    return post(server, json.dumps(update).encode(), **kwargs)
+
+
+def test_dispatch(bot, make_server):
+    received = []
+    bot.handlers['message'].append((lambda msg: msg.text == 'hello', received.append))
+    bot.handlers['message'].append((lambda msg: False, lambda msg: pytest.fail('criteria not met')))
+    server = make_server()
+
+    assert post_update(server, message_update(1)) == 200
+    assert post_update(server, message_update(2, text='bye')) == 200
+    server.join()
+    assert [msg.id for msg in received] == [1]
+    assert server.stats()['dispatched'] == 2
+
+
+def test_secret_token(make_server):
+    server = make_server()
+    assert post_update(server, message_update(1), token='wrong') == 403
+    assert post_update(server, message_update(1), token=None) == 403
+    assert post_update(server, message_update(1), token='') == 403
+    assert server.stats()['rejected'] == 3
+    assert server.stats()['received'] == 0
+
+
+def test_bad_body(make_server):
+    server = make_server()
+    assert post(server, b'not json') == 400
+    assert post(server, b'[1, 2]') == 400
+    assert post(server, b'') == 400
+    # Refused from the header, before reading the body
+    assert post(server, b'{}', length=MAX_BODY_SIZE + 1) == 400
+    assert post_update(server, message_update(1), path='/other') == 404
+    assert server.stats()['received'] == 0
+
+
+def test_queue_full(bot, make_server):
+    release = threading.Event()
+    started = threading.Event()
+
+    def block(msg):
+        started.set()
+        release.wait(5)
+
+    bot.handlers['message'].append((lambda msg: True, block))
+    server = make_server(queue_size=1, workers=1)
+    try:
+        assert post_update(server, message_update(1)) == 200
+        assert started.wait(5)     # the worker holds the first update
+        assert post_update(server, message_update(2)) == 200
+        assert post_update(server, message_update(3)) == 503
+        assert server.stats()['dropped'] == 1
+    finally:
+        release.set()
+    server.join()
+    assert server.stats()['dispatched'] == 2
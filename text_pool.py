@@ -0,0 +1,97 @@
+import collections
+import logging
+import threading
+import time
+
+from challenge import TextReadingChallenge
+
+
+class TextPool:
+    """
+    Bounded pool of ready-made TextReadingChallenge texts. A background thread refills the pool up to `size` whenever
+    it drops to `low_watermark`, so that taking a text on the join path never touches the network.
+    """
+
+    def __init__(self, user_agent: str, size: int = 50, low_watermark: int = 10, batch_size: int = 10,
+                 retry_delay: float = 30):
+        self.size = size
+        self.batch_size = batch_size
+        self.low_watermark = min(low_watermark, size)
+        self.retry_delay = retry_delay
+        self._user_agent = user_agent
+        self._texts: collections.deque[str] = collections.deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.errors = 0
+        self.empty = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._fill, name='text-pool', daemon=True)
+            self._thread.start()
+
+    def get(self) -> str | None:
+        """
+        Take a text from the pool, or return None if it is empty.
+        """
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            try:
+                text = self._texts.popleft()
+            except IndexError:
+                self.misses += 1
+                text = None
+            else:
+                self.hits += 1
+            if len(self._texts) <= self.low_watermark:
+                self._cond.notify()
+        return text
+
+    def __len__(self):
+        return len(self._texts)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._texts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'fetched': self.fetched,
+            'errors': self.errors,
+            'empty': self.empty
+        }
+
+    def _fetch(self) -> list[str]:
+        return TextReadingChallenge.fetch_texts(TextReadingChallenge.shared_site(self._user_agent), self.batch_size)
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                while len(self._texts) > self.low_watermark:
+                    self._cond.wait()
+            while len(self._texts) < self.size:
+                try:
+                    texts = self._fetch()
+                except Exception as e:
+                    self.errors += 1
+                    TextReadingChallenge.reset_site()
+                    logging.warning(f'Failed to prefetch challenge text: {e}')
+                    time.sleep(self.retry_delay)
+                    continue
+                if not texts:
+                    # No usable article in the batch. Querying again at once would only hammer Wikisource.
+                    self.empty += 1
+                    time.sleep(self.retry_delay)
+                    continue
+                with self._cond:
+                    texts = texts[:self.size - len(self._texts)]
+                    self._texts.extend(texts)
+                    self.fetched += len(texts)
@@ -1,8 +1,248 @@
+import heapq
+import itertools
+import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    def __init__(self, deadline: float, callback, args: tuple, kwargs: dict, kind: str = 'default'):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.kind = kind
+        self.cancelled = False
+        self.fired = False
+
+
+class JobStats:
+    """
+    Counters of one kind of job. Lateness is measured from the deadline to the moment the callback starts running,
+    so it includes time spent waiting for a free worker.
+    """
+
+    def __init__(self):
+        self.pending = 0    # waiting for the deadline
+        self.queued = 0     # due, waiting for a worker
+        self.fired = 0
+        self.cancelled = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'pending': self.pending,
+            'queued': self.queued,
+            'fired': self.fired,
+            'cancelled': self.cancelled,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+            'mean_lateness': self.total_lateness / self.fired if self.fired else 0.0
+        }
+
+
+class Scheduler:
+    """
+    One worker thread keeps every pending deadline in a heap and wakes up only for the earliest one. Expired jobs are
+    handed to a small thread pool so that a slow callback (usually an HTTP call) never delays the next deadline.
+    Cancelling is O(1): the job is only flagged and dropped lazily when it reaches the top of the heap.
+    """
+
+    def __init__(self, workers: int = 8, pools: dict[str, int] | None = None):
+        """
+        :param pools: Workers of a pool of their own, by kind of job. Jobs that may wait long in a callback, e.g. for
+            the outbound rate limiter, are given one, so that they never hold up other kinds of jobs.
+        """
+        self._heap: list[tuple[float, int, Job]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = workers
+        self._pools = dict(pools or {})
+        self._executor: ThreadPoolExecutor | None = None
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._thread: threading.Thread | None = None
+        self._dead = 0
+        self._stats: dict[str, JobStats] = {}
+        self._total = JobStats()
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='scheduler')
+            self._executors = {
+                kind: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'scheduler-{kind}')
+                for kind, workers in self._pools.items()
+            }
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def call_later(self, delay: float, callback, *args, **kwargs) -> Job:
+        return self.schedule('default', delay, callback, *args, **kwargs)
+
+    def schedule(self, kind: str, delay: float, callback, *args, **kwargs) -> Job:
+        """
+        Like call_later(), with the job counted under `kind` in stats().
+        """
+        if self._thread is None:
+            self.start()
+        job = Job(time.monotonic() + delay, callback, args, kwargs, kind)
+        with self._cond:
+            heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+            for stats in self._stats_of(kind):
+                stats.pending += 1
+            if self._heap[0][2] is job:
+                self._cond.notify()
+        return job
+
+    def cancel(self, job: Job) -> bool:
+        with self._cond:
+            if job.cancelled or job.fired:
+                return False
+            job.cancelled = True
+            for stats in self._stats_of(job.kind):
+                stats.pending -= 1
+                stats.cancelled += 1
+            self._dead += 1
+            if self._dead > 64 and self._dead > len(self._heap) // 2:
+                self._compact()
+        return True
+
+    @property
+    def pending(self) -> int:
+        return self._total.pending
+
+    def stats(self, kind: str | None = None) -> dict:
+        """
+        :param kind: Kind of jobs to report, or None for all jobs
+        """
+        if kind is None:
+            return self._total.as_dict()
+        return self._stats.get(kind, JobStats()).as_dict()
+
+    def kinds(self) -> list[str]:
+        return list(self._stats)
+
+    def _stats_of(self, kind: str) -> tuple[JobStats, JobStats]:
+        stats = self._stats.get(kind)
+        if stats is None:
+            stats = self._stats[kind] = JobStats()
+        return stats, self._total
+
+    def _compact(self):
+        self._heap = [item for item in self._heap if not item[2].cancelled]
+        heapq.heapify(self._heap)
+        self._dead = 0
+
+    def _pop_due(self) -> Job:
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._dead -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    break
+                self._cond.wait(delay)
+
+            _, _, job = heapq.heappop(self._heap)
+            job.fired = True
+            for stats in self._stats_of(job.kind):
+                stats.pending -= 1
+                stats.queued += 1
+        return job
+
+    def _execute(self, job: Job):
+        lateness = time.monotonic() - job.deadline
+        with self._cond:
+            for stats in self._stats_of(job.kind):
+                stats.queued -= 1
+                stats.fired += 1
+                stats.last_lateness = lateness
+                stats.max_lateness = max(stats.max_lateness, lateness)
+                stats.total_lateness += lateness
+        try:
+            return job.callback(*job.args, **job.kwargs)
+        except Exception:
+            logging.exception(f'Scheduled {job.kind} job failed')
+
+    def _run(self):
+        while True:
+            job = self._pop_due()
+            try:
+                self._executors.get(job.kind, self._executor).submit(self._execute, job)
+            except RuntimeError:    # the executor was shut down as the interpreter exits
+                return
+
+
+class TimeoutRegistry:
+    """
+    Pending timeouts indexed by (chat_id, msg_id) and by (chat_id, user_id), so that button clicks and member updates
+    find their challenge without scanning every pending one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_chat: dict[int, dict[int, 'Timeout']] = {}
+        self._by_user: dict[tuple[int, int], dict[int, 'Timeout']] = {}
+        self._count = 0
+
+    def add(self, timeout: 'Timeout'):
+        with self._lock:
+            chat = self._by_chat.setdefault(timeout.chat_id, {})
+            if timeout.msg_id not in chat:
+                self._count += 1
+            chat[timeout.msg_id] = timeout
+            self._by_user.setdefault((timeout.chat_id, timeout.user_id), {})[timeout.msg_id] = timeout
+
+    def remove(self, timeout: 'Timeout') -> bool:
+        with self._lock:
+            chat = self._by_chat.get(timeout.chat_id)
+            if chat is None or chat.get(timeout.msg_id) is not timeout:
+                return False
+            del chat[timeout.msg_id]
+            if not chat:
+                del self._by_chat[timeout.chat_id]
+            user_key = (timeout.chat_id, timeout.user_id)
+            user = self._by_user[user_key]
+            del user[timeout.msg_id]
+            if not user:
+                del self._by_user[user_key]
+            self._count -= 1
+            return True
+
+    def by_message(self, chat_id: int, msg_id: int) -> 'Timeout | None':
+        chat = self._by_chat.get(chat_id)
+        return chat.get(msg_id) if chat is not None else None
+
+    def by_user(self, chat_id: int, user_id: int) -> list['Timeout']:
+        with self._lock:
+            return list(self._by_user.get((chat_id, user_id), {}).values())
+
+    def by_chat(self, chat_id: int) -> list['Timeout']:
+        with self._lock:
+            return list(self._by_chat.get(chat_id, {}).values())
+
+    def chats(self) -> dict[int, int]:
+        with self._lock:
+            return {chat_id: len(chat) for chat_id, chat in self._by_chat.items()}
+
+    def all(self) -> list['Timeout']:
+        with self._lock:
+            return [timeout for chat in self._by_chat.values() for timeout in chat.values()]
+
+    def __len__(self):
+        return self._count
 
 
 class Timeout:
-    _running: list['Timeout'] = []
+    registry = TimeoutRegistry()
 
     def __init__(self, chat_id: int, user_id: int, msg_id: int, timer: int):
         self.chat_id = chat_id
@@ -10,30 +250,90 @@ class Timeout:
         self.msg_id = msg_id
         self._valid = False
         self.timer = timer
+        self._job: Job | None = None
+        self._scheduler: Scheduler | None = None
 
-    def run(self, callback, **callback_args):
-        Timeout._add_to_list(self)
+    def start(self, scheduler: Scheduler, callback, **callback_args):
+        Timeout.registry.add(self)
         self._valid = True
-        time.sleep(self.timer)
-        Timeout._remove_from_list(self)
+        self._scheduler = scheduler
+        self._job = scheduler.schedule('challenge', self.timer, self._expire, callback, callback_args)
+
+    def _expire(self, callback, callback_args: dict):
+        Timeout.registry.remove(self)
         if self._valid:
-            result = callback(**callback_args)
             self._valid = False
-            return result
+            return callback(**callback_args)
         else:
             return None
 
     def stop(self):
+        if not self._valid:
+            return
         self._valid = False
+        if self._job is not None and self._scheduler.cancel(self._job):
+            Timeout.registry.remove(self)
+
+    @classmethod
+    def find_by_message(cls, chat_id: int, msg_id: int) -> 'Timeout | None':
+        return cls.registry.by_message(chat_id, msg_id)
 
     @classmethod
-    def _add_to_list(cls, timeout):
-        cls._running.append(timeout)
+    def find_by_user(cls, chat_id: int, user_id: int) -> list['Timeout']:
+        return cls.registry.by_user(chat_id, user_id)
 
     @classmethod
-    def list_all(cls):
-        return cls._running
+    def list_chat(cls, chat_id: int) -> list['Timeout']:
+        return cls.registry.by_chat(chat_id)
 
     @classmethod
-    def _remove_from_list(cls, timeout):
-        cls._running.remove(timeout)
+    def list_all(cls) -> list['Timeout']:
+        return cls.registry.all()
+
+
+class ChatBatcher:
+    """
+    Group items pushed for the same chat within `interval` seconds, and hand them over in one call. Timeouts started
+    by one burst of joins expire in one burst too, and are then handled as a batch per chat.
+    """
+
+    def __init__(self, handle, scheduler: Scheduler, interval: float = 1, kind: str = 'batch'):
+        """
+        :param handle: Callable taking (chat_id, items)
+        """
+        self._handle = handle
+        self._scheduler = scheduler
+        self.interval = interval
+        self.kind = kind
+        self._pending: dict[int, list] = {}
+        self._lock = threading.Lock()
+
+        self.items = 0
+        self.batches = 0
+
+    def push(self, chat_id: int, item):
+        with self._lock:
+            self.items += 1
+            items = self._pending.get(chat_id)
+            if items is not None:
+                items.append(item)
+                return
+            self._pending[chat_id] = [item]
+        self._scheduler.schedule(self.kind, self.interval, self.flush, chat_id)
+
+    def flush(self, chat_id: int):
+        with self._lock:
+            items = self._pending.pop(chat_id, None)
+        if not items:
+            return
+        self.batches += 1
+        self._handle(chat_id, items)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = sum(len(items) for items in self._pending.values())
+        return {
+            'items': self.items,
+            'batches': self.batches,
+            'pending': pending
+        }
@@ -0,0 +1,192 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import catbot
+
+from routing import ChatRouter, update_chat_id
+
+UPDATE_TYPES = {
+    'message': catbot.Message,
+    'callback_query': catbot.CallbackQuery,
+    'chat_member': catbot.ChatMemberUpdate
+}
+MAX_BODY_SIZE = 1 << 20
+
+
+class WebhookServer:
+    """
+    Receive updates pushed by Telegram instead of long polling. The HTTP server only checks the secret token and
+    queues the update, and a fixed set of workers runs the handlers registered on the bot. When the queue is full the
+    request is refused with 503, and Telegram delivers the update again later.
+    """
+
+    def __init__(self, bot, host: str = '127.0.0.1', port: int = 8443, path: str = '/',
+                 secret_token: str = '', queue_size: int = 1000, workers: int = 16, router: ChatRouter | None = None):
+        """
+        :param bot: A CaptchaBot, whose `handlers` lists (criteria, handler) pairs per update type
+        :param router: Forwards updates of chats owned by other bot processes to them
+        """
+        self.bot = bot
+        self.router = router
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self._queue: queue.Queue[dict] = queue.Queue(maxsize=queue_size)
+        self._server = ThreadingHTTPServer((host, port), self._request_handler())
+        self._server.daemon_threads = True
+
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.dispatched = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, bot, router: ChatRouter | None = None) -> 'WebhookServer':
+        """
+        Refuse to serve without `webhook.secret_token`, as anyone reaching the server could then post forged updates,
+        and the token is also what forwarded updates are accepted by.
+        """
+        config = bot.config['webhook']
+        if not config.get('secret_token'):
+            raise ValueError('webhook.secret_token must be set in webhook mode')
+        return cls(
+            bot,
+            host=config.get('host', '127.0.0.1'),
+            port=int(config.get('port', 8443)),
+            path=config.get('path', '/'),
+            secret_token=config.get('secret_token', ''),
+            queue_size=int(config.get('queue_size', 1000)),
+            workers=int(config.get('workers', 16)),
+            router=router
+        )
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def set_webhook(self, url: str, max_connections: int = 40):
+        """
+        Ask Telegram to push updates to `url`, which should reach this server, e.g. through a reverse proxy.
+        """
+        data = {
+            'url': url,
+            'allowed_updates': list(UPDATE_TYPES),
+            'max_connections': max_connections
+        }
+        if self.secret_token:
+            data['secret_token'] = self.secret_token
+        self.bot.api('setWebhook', data)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'webhook-{i}', daemon=True).start()
+        threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True).start()
+
+    def serve_forever(self):
+        self.start()
+        threading.Event().wait()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def accept(self, update: dict) -> bool:
+        """
+        Queue an update for the workers, or forward it to the bot process owning its chat.
+        :return: False if the queue is full
+        """
+        self.received += 1
+        if self.router is not None:
+            chat_id = update_chat_id(update)
+            if not self.router.owns(chat_id) and self.router.forward(update, chat_id):
+                return True
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def dispatch(self, update: dict):
+        for update_type, update_class in UPDATE_TYPES.items():
+            if update_type in update:
+                item = update_class(update[update_type])
+                for criteria, handler in self.bot.handlers[update_type]:
+                    if criteria(item):
+                        handler(item)
+                return
+
+    def _work(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self.dispatch(update)
+            except Exception:
+                self.failed += 1
+                logging.exception(f'Failed to handle update {update.get("update_id")}')
+            else:
+                self.dispatched += 1
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Block until every queued update is handled.
+        """
+        self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+            'dispatched': self.dispatched,
+            'failed': self.failed,
+            'forwarded': self.router.forwarded if self.router is not None else 0
+        }
+
+    def _request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if server.secret_token and not hmac.compare_digest(token.encode(), server.secret_token.encode()):
+                    server.rejected += 1
+                    self._reply(403)
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = 0
+                if length <= 0 or length > MAX_BODY_SIZE:
+                    self._reply(400)
+                    return
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self._reply(400)
+                    return
+                if not isinstance(update, dict):
+                    self._reply(400)
+                    return
+                self._reply(200 if server.accept(update) else 503)
+
+            def _reply(self, code: int):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        return RequestHandler